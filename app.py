@@ -6,36 +6,59 @@
 # Last Modified Date: 23.04.2024
 # Last Modified By  : Yan <yanwong@126.com>
 
+from concurrent.futures import ThreadPoolExecutor
+import contextvars
 from datetime import datetime, date, timedelta
 import logging
+import os
 
 import gradio as gr
-import plotly.graph_objects as go
 
-from map_util import GaodeGeo, plot_markers_map
-from weather_util import GaodeWeather
-from video_util import BilibiliVideo
-from trip_advisor import QwenTripAdvisor, InternTripAdvisor, YiTripAdvisor
+from cache_util import SqliteCache
+from city_util import CityIndex
+from gazetteer_util import Gazetteer
+from http_util import configure_http_client
+from retry_util import RetryPolicy, REASON_PARSE
+from map_util import GaodeGeo, MapFigureCache, plot_markers_map
+from metrics_util import metrics, start_metrics_server, timed
+from route_util import DayRouter
+from scheduler_util import StageScheduler, StageBusy, current_session, in_session
+from weather_util import GaodeWeather, ForecastStore, WeatherClassifier
+from video_util import BilibiliVideo, VideoStore
+from trip_advisor import (
+    QwenTripAdvisor, InternTripAdvisor, YiTripAdvisor, HedgedTripAdvisor,
+    LazyTripAdvisor, GenerationFailure, validate_advise
+)
 
 logging.basicConfig(
     level=logging.INFO,
     format='%(asctime)s - %(levelname)s - %(message)s'
 )
 
-GAODE_GEOCODE_URL = 'https://restapi.amap.com/v3/geocode/geo'
-GAODE_WEATHER_URL = 'https://restapi.amap.com/v3/weather/weatherInfo'
-GAODE_STATICMAP_URL = 'https://restapi.amap.com/v3/staticmap'
-GAODE_POI_URL = 'https://restapi.amap.com/v3/place/text'
+# Hosts can be overridden, e.g. to point at the stub servers of benchmark/.
+GAODE_HOST = os.environ.get('WEGO_GAODE_HOST', 'https://restapi.amap.com')
+INTERNLM_HOST = os.environ.get(
+    'WEGO_INTERNLM_HOST', 'https://internlm-chat.intern-ai.org.cn')
+OPENXLAB_HOST = os.environ.get(
+    'WEGO_OPENXLAB_HOST', 'https://openapi.openxlab.org.cn')
+BAIDU_HOST = os.environ.get('WEGO_BAIDU_HOST', 'https://aip.baidubce.com')
+BILIBILI_HOST = os.environ.get('WEGO_BILIBILI_HOST', 'https://api.bilibili.com')
+
+GAODE_GEOCODE_URL = GAODE_HOST + '/v3/geocode/geo'
+GAODE_WEATHER_URL = GAODE_HOST + '/v3/weather/weatherInfo'
+GAODE_STATICMAP_URL = GAODE_HOST + '/v3/staticmap'
+GAODE_POI_URL = GAODE_HOST + '/v3/place/text'
 
 QWEN_LLM_NAME = 'qwen-max'
 
 INTERNLM_NAME = 'InternLM2-latest'
-INTERNLM_URL = 'https://internlm-chat.intern-ai.org.cn/puyu/api/v1/chat/completion'
+INTERNLM_URL = INTERNLM_HOST + '/puyu/api/v1/chat/completion'
+OPENXLAB_AUTH_URL = OPENXLAB_HOST + '/api/v1/sso-be/api/v1/open/'
 
-YI_AUTH_URL = 'https://aip.baidubce.com/oauth/2.0/token'
-YI_MODEL_URL = 'https://aip.baidubce.com/rpc/2.0/ai_custom/v1/wenxinworkshop/chat/yi_34b_chat'
+YI_AUTH_URL = BAIDU_HOST + '/oauth/2.0/token'
+YI_MODEL_URL = BAIDU_HOST + '/rpc/2.0/ai_custom/v1/wenxinworkshop/chat/yi_34b_chat'
 
-BILIBILI_SEARCH_URL = 'https://api.bilibili.com/x/web-interface/search/all/v2'
+BILIBILI_SEARCH_URL = BILIBILI_HOST + '/x/web-interface/search/all/v2'
 BILIBILI_EMBED_URL = '//player.bilibili.com/player.html'
 
 DEFAULT_MARKER_LOCATION = '121.460351,31.163443'
@@ -43,16 +66,169 @@ DEFAULT_MARKER_ADDRESS = '上海人工智能实验室'
 DEFAULT_BILIBILI_AID = '1351359862'
 DEFAULT_BILIBILI_BVID = 'BV1Uz421D7Yk'
 
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+GEOCODE_CSV_PATH = os.path.join(DATA_DIR, 'geocode.csv')
+WEATHER_CLASS_CSV_PATH = os.path.join(DATA_DIR, 'weather_class.csv')
+# Built by build_gazetteer.py, attractions in it are never geocoded online.
+GAZETTEER_PATH = os.path.join(DATA_DIR, 'gazetteer.json')
+
+CACHE_DIR = os.environ.get(
+    'WEGO_CACHE_DIR',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cache')
+)
+LOCATION_CACHE_PATH = os.path.join(CACHE_DIR, 'location.db')
+LOCATION_CACHE_TTL = 30 * 24 * 3600
+LOCATION_CACHE_SIZE = 100000
+ADVISE_CACHE_PATH = os.path.join(CACHE_DIR, 'advise.db')
+ADVISE_CACHE_TTL = 7 * 24 * 3600
+ADVISE_CACHE_SIZE = 10000
+
+HTTP_CONNECT_TIMEOUT = float(os.environ.get('WEGO_HTTP_CONNECT_TIMEOUT', 3.05))
+HTTP_READ_TIMEOUT = float(os.environ.get('WEGO_HTTP_READ_TIMEOUT', 10))
+HTTP_POOL_HOSTS = int(os.environ.get('WEGO_HTTP_POOL_HOSTS', 10))
+HTTP_POOL_SIZE = int(os.environ.get('WEGO_HTTP_POOL_SIZE', 20))
+LLM_READ_TIMEOUT = float(os.environ.get('WEGO_LLM_READ_TIMEOUT', 120))
+
+# Comma separated backends among qwen, intern and yi. With more than one,
+# requests are hedged across them.
+TRIP_ADVISORS = os.environ.get('WEGO_TRIP_ADVISORS', 'yi').split(',')
+HEDGE_PERCENTILE = float(os.environ.get('WEGO_HEDGE_PERCENTILE', 0.9))
+HEDGE_DEFAULT_DEADLINE = float(os.environ.get('WEGO_HEDGE_DEFAULT_DEADLINE', 30))
+
+ADVISE_MAX_RETRY = 3
+ADVISE_RETRY_BASE_DELAY = 0.5
+ADVISE_RETRY_MAX_DELAY = 8
+ADVISE_MAX_REPAIR = 2
+
+# Days whose stops spread wider are reported, stops are reordered when it
+# shortens the day's route by at least ROUTE_MIN_SAVING_KM.
+ROUTE_MAX_SPREAD_KM = float(os.environ.get('WEGO_ROUTE_MAX_SPREAD_KM', 30))
+ROUTE_MIN_SAVING_KM = 1.0
+
+# Serialized maps of cities and plans drawn recently.
+MAP_CACHE_SIZE = 1024
+
+# Prometheus metrics are served at http://host:WEGO_METRICS_PORT/metrics,
+# 0 disables.
+METRICS_PORT = int(os.environ.get('WEGO_METRICS_PORT', 9100))
+
+PIPELINE_WORKERS = int(os.environ.get('WEGO_PIPELINE_WORKERS', 16))
+
+# Calls of each stage running at once, over all sessions. A session runs at
+# most STAGE_SESSION_LIMIT calls of a stage at once, and calls are turned
+# away when STAGE_QUEUE_SIZE others already wait for the stage or no slot
+# frees up within STAGE_WAIT_TIMEOUT seconds.
+STAGE_LIMITS = {
+    'llm': int(os.environ.get('WEGO_LLM_CONCURRENCY', 8)),
+    'geocode': int(os.environ.get('WEGO_GEOCODE_CONCURRENCY', 16)),
+    'video': int(os.environ.get('WEGO_VIDEO_CONCURRENCY', 4)),
+    'map': int(os.environ.get('WEGO_MAP_CONCURRENCY', 8)),
+}
+STAGE_SESSION_LIMIT = int(os.environ.get('WEGO_STAGE_SESSION_LIMIT', 1))
+STAGE_QUEUE_SIZE = int(os.environ.get('WEGO_STAGE_QUEUE_SIZE', 64))
+STAGE_WAIT_TIMEOUT = float(os.environ.get('WEGO_STAGE_WAIT_TIMEOUT', 120))
+# Gradio runs up to twice the stage's slots of each kind of event, so the
+# stage picks among sessions fairly, and keeps up to EVENT_QUEUE_SIZE more
+# events in its queue before rejecting new ones.
+EVENT_QUEUE_SIZE = int(os.environ.get('WEGO_EVENT_QUEUE_SIZE', 256))
+
+FORECAST_REFRESH_INTERVAL = 3 * 3600
+# Keep forecasts of the most requested cities warm in background, 0 disables.
+FORECAST_PREFETCH_TOP_N = int(os.environ.get('WEGO_FORECAST_PREFETCH_TOP_N', 0))
+FORECAST_PREFETCH_INTERVAL = 300
+
+VIDEO_CACHE_TTL = 7 * 24 * 3600
+VIDEO_CACHE_SIZE = 2048
+# Keep videos of the most requested cities cached in background, 0 disables.
+# Once enabled, comma separated cities are fetched at start.
+VIDEO_PREFETCH_TOP_N = int(os.environ.get('WEGO_VIDEO_PREFETCH_TOP_N', 0))
+VIDEO_PREFETCH_INTERVAL = 600
+VIDEO_PREFETCH_CITIES = [
+    c for c in os.environ.get('WEGO_VIDEO_PREFETCH_CITIES', '').split(',') if c
+]
+
 logger = logging.getLogger(__name__)
 
-wg_geo = GaodeGeo(GAODE_GEOCODE_URL, GAODE_POI_URL, GAODE_STATICMAP_URL)
+wg_scheduler = StageScheduler(
+    STAGE_LIMITS, max_waiting=STAGE_QUEUE_SIZE,
+    per_session=STAGE_SESSION_LIMIT, wait_timeout=STAGE_WAIT_TIMEOUT)
+wg_executor = ThreadPoolExecutor(
+    max_workers=PIPELINE_WORKERS, thread_name_prefix='wego-pipeline')
+wg_http = configure_http_client(
+    connect_timeout=HTTP_CONNECT_TIMEOUT, read_timeout=HTTP_READ_TIMEOUT,
+    pool_connections=HTTP_POOL_HOSTS, pool_maxsize=HTTP_POOL_SIZE
+)
+wg_city_index = CityIndex(GEOCODE_CSV_PATH)
+wg_location_cache = SqliteCache(
+    LOCATION_CACHE_PATH, table='location',
+    ttl=LOCATION_CACHE_TTL, max_entries=LOCATION_CACHE_SIZE
+)
+wg_gazetteer = Gazetteer(GAZETTEER_PATH)
+wg_geo = GaodeGeo(GAODE_GEOCODE_URL, GAODE_POI_URL, GAODE_STATICMAP_URL,
+                  city_index=wg_city_index, location_cache=wg_location_cache,
+                  gazetteer=wg_gazetteer)
 wg_weather = GaodeWeather(wg_geo, GAODE_WEATHER_URL)
+wg_weather_classifier = WeatherClassifier(WEATHER_CLASS_CSV_PATH)
+wg_forecast_store = ForecastStore(
+    wg_weather, refresh_interval=FORECAST_REFRESH_INTERVAL)
+if FORECAST_PREFETCH_TOP_N > 0:
+    wg_forecast_store.start_refresher(
+        FORECAST_PREFETCH_TOP_N, FORECAST_PREFETCH_INTERVAL)
+wg_day_router = DayRouter(
+    max_spread_km=ROUTE_MAX_SPREAD_KM, min_saving_km=ROUTE_MIN_SAVING_KM)
+wg_advise_cache = SqliteCache(
+    ADVISE_CACHE_PATH, table='advise',
+    ttl=ADVISE_CACHE_TTL, max_entries=ADVISE_CACHE_SIZE
+)
+wg_map_cache = MapFigureCache(max_entries=MAP_CACHE_SIZE)
 wg_video = BilibiliVideo(BILIBILI_SEARCH_URL, BILIBILI_EMBED_URL)
-# wg_trip_advisor = QwenTripAdvisor(QWEN_LLM_NAME)
-# wg_trip_advisor = InternTripAdvisor(INTERNLM_NAME, INTERNLM_URL)
-wg_trip_advisor = YiTripAdvisor(YI_AUTH_URL, YI_MODEL_URL)
-
-def create_trip_brief(city, days, first_date):
+wg_video_store = VideoStore(
+    wg_video, ttl=VIDEO_CACHE_TTL, max_entries=VIDEO_CACHE_SIZE)
+if VIDEO_PREFETCH_TOP_N > 0:
+    wg_video_store.start_refresher(
+        VIDEO_PREFETCH_TOP_N, VIDEO_PREFETCH_INTERVAL, VIDEO_PREFETCH_CITIES)
+
+def create_trip_advisor(name):
+    if name == 'qwen':
+        return QwenTripAdvisor(QWEN_LLM_NAME, request_timeout=LLM_READ_TIMEOUT)
+    if name == 'intern':
+        return InternTripAdvisor(
+            INTERNLM_NAME, INTERNLM_URL,
+            request_timeout=(HTTP_CONNECT_TIMEOUT, LLM_READ_TIMEOUT),
+            auth_url=OPENXLAB_AUTH_URL)
+    if name == 'yi':
+        return YiTripAdvisor(
+            YI_AUTH_URL, YI_MODEL_URL,
+            request_timeout=(HTTP_CONNECT_TIMEOUT, LLM_READ_TIMEOUT))
+    raise ValueError(f'Unknown trip advisor: {name}')
+
+def create_configured_trip_advisor():
+    advisors = {
+        name.strip(): create_trip_advisor(name.strip()) for name in TRIP_ADVISORS
+    }
+    if len(advisors) == 1:
+        return next(iter(advisors.values()))
+    # Every request admitted to the llm stage may run all backends at once.
+    return HedgedTripAdvisor(
+        advisors, hedge_percentile=HEDGE_PERCENTILE,
+        default_deadline=HEDGE_DEFAULT_DEADLINE,
+        max_workers=STAGE_LIMITS['llm'] * len(advisors))
+
+# The backends of WEGO_TRIP_ADVISORS are built on the first generation, so
+# provider SDKs are imported and logged in to only when needed.
+wg_trip_advisor = LazyTripAdvisor(create_configured_trip_advisor)
+wg_retry_policy = RetryPolicy(
+    max_retry=ADVISE_MAX_RETRY, base_delay=ADVISE_RETRY_BASE_DELAY,
+    max_delay=ADVISE_RETRY_MAX_DELAY)
+
+metrics.register_cache('location', wg_location_cache)
+metrics.register_cache('advise', wg_advise_cache)
+metrics.register_cache('forecast', wg_forecast_store)
+metrics.register_cache('video', wg_video_store)
+metrics.register_cache('map', wg_map_cache)
+
+@timed('create_trip_brief')
+def create_trip_brief(city, days, first_date, geocode=None):
     if days < 1 or days > 7:
         logger.warning(f'Invalid days: {days}')
         gr.Warning('Days should be in range [1, 7].')
@@ -72,7 +248,8 @@ def create_trip_brief(city, days, first_date):
         gr.Warning('Invalid date format.')
         return None
 
-    geocode = wg_geo.get_geocode(city)
+    if not geocode:
+        geocode = resolve_city_geocode(city)
     if not geocode:
         logger.warning('Can not get geocode of city: {}'.format(city))
         return None
@@ -86,85 +263,214 @@ def create_trip_brief(city, days, first_date):
         'duration': f'{days}天', 'std_city': std_city
     }
 
-    forecast = wg_weather.get_forecast(top1_geocode)
+    with wg_scheduler.slot('geocode'):
+        forecast = wg_forecast_store.get_forecast(adcode)
     if not forecast:
         logger.warning('Can not get forecast of city: {}'.format(city))
 
-    weathers = []
-    for td in trip_dates:
-        i = 0
-        while i < len(forecast):
-            if forecast[i]['date'] == td:
-                weathers.append(forecast[i])
-                break
-            i += 1
-        if i == len(forecast):
-            weathers.append(
-                {'date': td, 'day_weather': '未知', 'night_weather': '未知'}
-            )
+    weathers = [
+        forecast.get(td) or
+        {'date': td, 'day_weather': '未知', 'night_weather': '未知'}
+        for td in trip_dates
+    ]
 
     trip_brief['weathers'] = weathers
     return trip_brief
 
-def generate_trip_advise(trip_brief, max_retry=3):
-    advise = {}
-    i = 0
-    while i < max_retry:
-        advise = wg_trip_advisor.generate_advise(trip_brief)
-        if advise:
+@wg_scheduler.limited('geocode')
+def resolve_city_geocode(city):
+    # Most cities can be resolved offline, only ask Gaode for the rest.
+    geocode = wg_city_index.resolve(city)
+    if not geocode:
+        geocode = wg_geo.get_geocode(city)
+    return geocode
+
+def resolve_city(city, place=None):
+    # place is the session's record of the last city typed in: its geocode
+    # and, once shown on the map, its location. It is reused as long as
+    # the input does not change.
+    city = (city or '').strip()
+    if place and place['city'] == city and place['geocode']:
+        return place
+    return {
+        'city': city,
+        'geocode': resolve_city_geocode(city) if city else [],
+        'location': None
+    }
+
+def advise_cache_key(trip_brief):
+    # Trips to the same place for the same days with similar weather get
+    # the same advise, so weathers are reduced to coarse classes.
+    weather_profile = [
+        wg_weather_classifier.classify(w['day_weather']) + '/' +
+        wg_weather_classifier.classify(w['night_weather'])
+        for w in trip_brief['weathers']
+    ]
+    return wg_advise_cache.make_key(
+        trip_brief['adcode'], len(trip_brief['weathers']), *weather_profile)
+
+def get_cached_advise(trip_brief):
+    advise = wg_advise_cache.get(advise_cache_key(trip_brief))
+    if advise:
+        logger.info('Advise cache hit, stats: {}'.format(wg_advise_cache.stats()))
+    return advise
+
+def cache_advise(trip_brief, advise):
+    if advise:
+        wg_advise_cache.set(advise_cache_key(trip_brief), advise)
+
+@timed('validate_trip_advise')
+def validate_trip_advise(trip_brief, advise, max_repair=ADVISE_MAX_REPAIR):
+    # Regenerates only the invalid days of the advise. Returns None when
+    # nothing can be kept and the whole plan has to be generated again.
+    num_days = len(trip_brief['weathers'])
+    for i in range(max_repair + 1):
+        invalid = validate_advise(advise, num_days)
+        if not invalid:
+            advise['days'] = advise['days'][:num_days]
+            return advise
+
+        logger.warning('Invalid days in advise: {}'.format(
+            {d + 1: problems for d, problems in invalid.items()}))
+        if len(invalid) == num_days or i == max_repair:
+            break
+        repaired = wg_trip_advisor.repair_advise(trip_brief, advise, invalid)
+        if not repaired:
             break
-        i += 1
-        logger.warning(f'Retry to generate advise for the {i}th time...')
+        advise = repaired
+
+    days = advise.get('days') if isinstance(advise, dict) else None
+    # Duplicated or malformed stops are still worth showing, missing days
+    # are not.
+    if len(invalid) < num_days and isinstance(days, list) and \
+            len(days) >= num_days and all(
+                isinstance(d, dict) and d.get('schedule') for d in days):
+        advise['days'] = days[:num_days]
+        return advise
+    return None
+
+@timed('route_trip_advise')
+def route_trip_advise(trip_brief, advise):
+    # Reorders the stops of each day into a shorter route locally instead
+    # of asking the LLM again. The locations are cached for the map.
+    try:
+        days = advise['days']
+        addresses = [sch['location'] for day in days for sch in day['schedule']]
+        loclists = wg_geo.get_locations(addresses, trip_brief['adcode'])
+        advise['days'], _ = wg_day_router.route_days(days, loclists)
+    except Exception as e:
+        logger.error('Route trip advise failed: {}'.format(e))
+    return advise
 
-    if i == max_retry:
-        logger.error(f'Generate trip advise failed for {i} times.')
+def generate_valid_advise(trip_brief):
+    # Each attempt takes an LLM slot of its own, so the slot is free while
+    # the retry policy waits between attempts.
+    with wg_scheduler.slot('llm'):
+        advise = wg_trip_advisor.try_generate_advise(trip_brief)
+        if not advise:
+            return advise
+        advise = validate_trip_advise(trip_brief, advise)
+    if not advise:
+        return GenerationFailure(REASON_PARSE, 'Invalid advise')
+    return route_trip_advise(trip_brief, advise)
+
+@timed('generate_trip_advise')
+def generate_trip_advise(trip_brief):
+    advise = get_cached_advise(trip_brief)
+    if advise:
+        return advise
+
+    advise = wg_retry_policy.call(generate_valid_advise, trip_brief)
+    if not advise:
+        logger.error('Generate trip advise failed: {!r}'.format(advise))
         return None
     advise['adcode'] = trip_brief['adcode']
+    cache_advise(trip_brief, advise)
     return advise
 
 def embed_default_video():
     return wg_video.get_embed_html_by_id(
             DEFAULT_BILIBILI_AID, DEFAULT_BILIBILI_BVID)
 
+@timed('embed_city_video')
+@wg_scheduler.limited('video')
 def embed_city_video(city):
     if not city:
         logger.warning(f'No city provided for searching video.')
         gr.Warning(f'No city provided for searching video.')
         return embed_default_video()
 
-    keyword = city + '宣传片'
     gr.Info('Searching videos.')
-    videoinfo = wg_video.search_video(keyword)
+    videoinfo = wg_video_store.get_video(city)
     if not videoinfo:
-        logger.warning(f'No video of {keyword} found.')
+        logger.warning(f'No video of {city} found.')
         gr.Warning(f'No video of {city} found.')
         return embed_default_video()
 
-    return wg_video.get_embed_html(videoinfo[0])
+    return wg_video.get_embed_html(videoinfo)
+
+def submit(fn, *args):
+    # Copy the context so that gr.Info/gr.Warning raised in the worker
+    # still reach the session that triggered the event.
+    return wg_executor.submit(contextvars.copy_context().run, fn, *args)
+
+def bind_session(request):
+    # Stages share their slots fairly among the sessions of the requests.
+    if request is not None:
+        current_session.set(request.session_hash)
+    return current_session.get()
+
+def warn_busy(e):
+    logger.warning('Turned away: {}'.format(e))
+    gr.Warning('Too many trips are being planned, please try again later.')
+
+def embed_city_video_by_input(city, place=None, request: gr.Request = None):
+    # The video does not depend on the trip plan, so it is searched right
+    # away with the session's or the offline city resolution instead of
+    # waiting for the brief.
+    bind_session(request)
+    if place and place['city'] == (city or '').strip() and place['geocode']:
+        geocode = place['geocode']
+    else:
+        geocode = wg_city_index.resolve(city)
+    std_city = geocode[0]['formatted_address'] if geocode else city
+    try:
+        return embed_city_video(std_city)
+    except StageBusy as e:
+        warn_busy(e)
+        return embed_default_video()
 
-def get_trip_brief_and_video(city, days, first_date):
-    brief = create_trip_brief(city, days, first_date)
+@timed('get_trip_brief_and_map')
+def get_trip_brief_and_map(city, days, first_date, place=None,
+                           request: gr.Request = None):
+    # The city resolved while previewing it on the map is reused.
+    bind_session(request)
+    try:
+        place = resolve_city(city, place)
+        map_future = submit(mark_city_on_map, place['city'], place)
+        brief = create_trip_brief(city, days, first_date, place['geocode'])
+        map_fig = map_future.result()
+    except StageBusy as e:
+        warn_busy(e)
+        return None, gr.update(), place
     if not brief:
         logger.warning('Trip brief is None.')
-        return None, None
-
-    std_city = brief.get('std_city')
-    embed_html = embed_city_video(std_city)
-    return brief, embed_html
-
-def get_trip_advise(brief):
-    if not brief:
-        logger.warning('No brief provided to generate advise.')
-        return None
-
-    logger.info(
-        'Start to generate advise based on the trip brief: {}'.format(brief)
-    )
-    gr.Info('Start to generate advise.')
-    advise = generate_trip_advise(brief)
-    logger.info('Generated advise (in JSON): {}'.format(advise))
-    gr.Info('Generation completed.')
-    return advise
+    return brief, map_fig, place
+
+def preview_city_on_map(city, place=None, request: gr.Request = None):
+    # Runs when the city box loses focus. Leaving the box without changing
+    # the city keeps the map as is.
+    if place and place['city'] == (city or '').strip() and \
+            place['location'] is not None:
+        return gr.update(), place
+    bind_session(request)
+    try:
+        place = resolve_city(city, place)
+        return mark_city_on_map(place['city'], place), place
+    except StageBusy as e:
+        # A preview is not worth a warning, GO shows the city anyway.
+        logger.warning('Skip preview: {}'.format(e))
+        return gr.update(), place
 
 def mark_default_location_on_map():
     traces = [{
@@ -173,19 +479,49 @@ def mark_default_location_on_map():
         'addresses': [DEFAULT_MARKER_ADDRESS]
     }]
 
-    return plot_markers_map(traces)
+    return wg_map_cache.plot(traces)
 
-def mark_city_on_map(city):
+@timed('mark_city_on_map')
+@wg_scheduler.limited('map')
+def mark_city_on_map(city, place=None):
     if city:
-        locations = wg_geo.get_location(city, city)
+        if place and place['city'] == city and place['location'] is not None:
+            locations = place['location']
+        else:
+            locations = wg_geo.get_location(city, city)
+            if place and place['city'] == city:
+                place['location'] = locations
         if locations:
             traces = [
                 {'trace': city, 'locations': locations[:1], 'addresses': [city]}
             ]
-            return plot_markers_map(traces)
+            return wg_map_cache.plot(traces)
 
     return mark_default_location_on_map()
 
+def mark_days_on_map(days, city):
+    # Geocode all stops of the days in one batch call.
+    addresses = [sch['location'] for day in days for sch in day['schedule']]
+    loclists = iter(wg_geo.get_locations(addresses, city))
+
+    traces = []
+    for day in days:
+        date_trace = {'trace': day['date']}
+        valid_locations, valid_addresses = [], []
+        for sch in day['schedule']:
+            addr = sch['location']
+            loclist = next(loclists)
+            if loclist:
+                valid_locations.append(loclist[0])
+                valid_addresses.append(addr)
+        date_trace.update({
+            'locations': valid_locations, 'addresses': valid_addresses
+        })
+        traces.append(date_trace)
+    return traces
+
+@timed('mark_advise_on_map')
+@wg_scheduler.limited('map')
 def mark_advise_on_map(advise):
     if not advise:
         logger.warning('No advise provided for plotting.')
@@ -194,26 +530,83 @@ def mark_advise_on_map(advise):
     traces = []
 
     try:
-        city = advise['adcode']
-
-        for day in advise['days']:
-            date_trace = {'trace': day['date']}
-            valid_locations, valid_addresses = [], []
-            for sch in day['schedule']:
-                addr = sch['location']
-                loclist = wg_geo.get_location(addr, city)
-                if loclist:
-                    valid_locations.append(loclist[0])
-                    valid_addresses.append(addr)
-            date_trace.update({
-                'locations': valid_locations, 'addresses': valid_addresses
-            })
-            traces.append(date_trace)
+        traces = mark_days_on_map(advise['days'], advise['adcode'])
     except Exception as e:
         logger.error('Mark advise locations on map failed: {}'.format(e))
 
-    return plot_markers_map(traces)
+    return wg_map_cache.plot(traces)
+
+@timed('stream_trip_advise')
+def stream_trip_advise(brief, request: gr.Request = None):
+    # The steps of a generator may run in different threads, so the
+    # session is bound to every step.
+    session = bind_session(request)
+    try:
+        yield from in_session(stream_trip_advise_steps(brief), session)
+    except StageBusy as e:
+        warn_busy(e)
+        yield None, gr.update(), *[gr.update()] * MAX_TRIP_DAYS
+
+def stream_trip_advise_steps(brief):
+    if not brief:
+        logger.warning('No brief provided to generate advise.')
+        yield None, mark_default_location_on_map(), *highlight_advise(brief, None)
+        return
+
+    logger.info(
+        'Start to stream advise based on the trip brief: {}'.format(brief)
+    )
+    advise = get_cached_advise(brief)
+    if advise:
+        yield advise, mark_advise_on_map(advise), *highlight_advise(brief, advise)
+        return
+
+    gr.Info('Start to generate advise.')
+
+    advise, traces, shown_days = None, [], []
+    with wg_scheduler.slot('llm'):
+        for partial in wg_trip_advisor.stream_advise(brief):
+            if not partial:
+                continue
+            partial['adcode'] = brief['adcode']
+            try:
+                # Days already on the map do not change, only plot new ones,
+                # unless another backend took over the stream.
+                if partial['days'][:len(shown_days)] != shown_days:
+                    traces, shown_days = [], []
+                traces.extend(mark_days_on_map(
+                    partial['days'][len(traces):], brief['adcode']))
+                shown_days = list(partial['days'][:len(traces)])
+            except Exception as e:
+                logger.error('Mark advise locations on map failed: {}'.format(e))
+            advise = partial
+            # Partial plans are drawn once, keep them out of the map cache.
+            yield advise, plot_markers_map(traces), \
+                *highlight_advise(brief, advise)
+
+        streamed_days = None
+        if advise and not advise.get('partial'):
+            streamed_days = list(advise.get('days') or [])
+            # Repairing days asks the LLM again.
+            advise = validate_trip_advise(brief, advise)
+
+    if streamed_days is not None and advise:
+        advise = route_trip_advise(brief, advise)
+        # Only redraw when some days were repaired or reordered.
+        if advise['days'] != streamed_days:
+            yield advise, mark_advise_on_map(advise), \
+                *highlight_advise(brief, advise)
+        cache_advise(brief, advise)
+
+    if not advise or advise.get('partial'):
+        logger.warning('Streaming generation failed, generate advise again.')
+        advise = generate_trip_advise(brief)
+        logger.info('Generated advise (in JSON): {}'.format(advise))
+        yield advise, mark_advise_on_map(advise), *highlight_advise(brief, advise)
 
+    gr.Info('Generation completed.')
+
+@timed('highlight_advise')
 def highlight_advise(brief, advise):
     if not advise:
         logger.warning('No advise for highlighting.')
@@ -284,30 +677,51 @@ with gr.Blocks() as demo:
         video_html = gr.HTML(label='随便看看')
 
     brief, advise = gr.State(), gr.State()
+    # The city resolved in this session, see resolve_city.
+    place = gr.State()
 
     demo.load(mark_default_location_on_map, outputs=[map_plot])
-    city.blur(mark_city_on_map, inputs=[city], outputs=[map_plot])
+    # Only the last of blur events fired in a row is handled.
+    city.blur(
+        preview_city_on_map,
+        inputs=[city, place],
+        outputs=[map_plot, place],
+        trigger_mode='always_last',
+        concurrency_limit=2 * STAGE_LIMITS['map'],
+        concurrency_id='map'
+    )
+    # The video search runs as its own event, so it neither delays the LLM
+    # call nor waits for it.
+    go_btn.click(
+        embed_city_video_by_input,
+        inputs=[city, place],
+        outputs=[video_html],
+        show_progress=True,
+        concurrency_limit=2 * STAGE_LIMITS['video'],
+        concurrency_id='video'
+    )
     go_btn.click(
-        get_trip_brief_and_video,
-        inputs=[city, days, first_date],
-        outputs=[brief, video_html],
-        show_progress=True
+        get_trip_brief_and_map,
+        inputs=[city, days, first_date, place],
+        outputs=[brief, map_plot, place],
+        show_progress=True,
+        concurrency_limit=2 * STAGE_LIMITS['geocode'],
+        concurrency_id='geocode'
     ).then(
-        get_trip_advise,
+        stream_trip_advise,
         inputs=[brief],
-        outputs=[advise],
-        show_progress=True
-    ).then(
-        mark_advise_on_map,
-        inputs=[advise],
-        outputs=[map_plot],
-        show_progress=True
-    ).then(
-        highlight_advise,
-        inputs=[brief, advise],
-        outputs=highlighted_texts,
-        show_progress=True
+        outputs=[advise, map_plot] + highlighted_texts,
+        show_progress=True,
+        concurrency_limit=2 * STAGE_LIMITS['llm'],
+        concurrency_id='llm'
     )
 
-demo.launch(show_error=True)
+    demo.queue(max_size=EVENT_QUEUE_SIZE)
+
+if __name__ == '__main__':
+    if METRICS_PORT:
+        start_metrics_server(METRICS_PORT)
+    # Enough threads for every event Gradio may run at once.
+    demo.launch(show_error=True,
+                max_threads=2 * sum(STAGE_LIMITS.values()) + PIPELINE_WORKERS)
 
@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# File              : batch_plan.py
+# Author            : Yan <yanwong@126.com>
+# Date              : 17.10.2026
+# Last Modified Date: 17.10.2026
+# Last Modified By  : Yan <yanwong@126.com>
+
+# Plans trips without the UI, e.g. for campaigns or to warm the caches.
+# Every line of the input is a trip request like
+#
+#   {"id": "hz-3", "city": "杭州", "days": 3, "first_date": "2024-05-01"}
+#
+# and goes through the same brief, advise and geocode steps as a trip
+# planned in the app. Results are appended to the output as they finish,
+# one JSON line per request, e.g.
+#
+#   python batch_plan.py trips.jsonl --output plans.jsonl --workers 8 \
+#       --rate gaode=50 --rate yi=2 --resume
+#
+# With --resume, requests already planned in the output are skipped, so an
+# interrupted run picks up where it stopped. Failed requests are planned
+# again and the last line of an id counts.
+
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import json
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+DASHSCOPE_URL = os.environ.get(
+    'DASHSCOPE_HTTP_BASE_URL', 'https://dashscope.aliyuncs.com/api/v1')
+
+def provider_urls(app):
+    return {
+        'gaode': app.GAODE_HOST,
+        'yi': app.BAIDU_HOST,
+        'intern': app.INTERNLM_HOST,
+        'qwen': DASHSCOPE_URL,
+    }
+
+def parse_rates(rates, urls):
+    # ['gaode=50', 'yi=2'] -> {url: 50.0, ...}
+    limits = {}
+    for rate in rates:
+        provider, _, value = rate.partition('=')
+        if provider not in urls:
+            raise ValueError('Unknown provider {}, choose among {}'.format(
+                provider, ', '.join(urls)))
+        limits[urls[provider]] = float(value)
+    return limits
+
+def request_id(request, lineno):
+    return str(request.get('id', lineno))
+
+def read_done_ids(output_path):
+    # Ids planned without error in a previous run. A line cut off by an
+    # interrupted run is ignored.
+    done = set()
+    if not os.path.exists(output_path):
+        return done
+    with open(output_path, encoding='utf-8') as f:
+        for line in f:
+            try:
+                result = json.loads(line)
+            except ValueError:
+                continue
+            if result.get('error'):
+                done.discard(result['id'])
+            else:
+                done.add(result['id'])
+    return done
+
+def iter_requests(input_path, done):
+    # Reads the input lazily, so large inputs are never held in memory.
+    with open(input_path, encoding='utf-8') as f:
+        for lineno, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                request = json.loads(line)
+            except ValueError as e:
+                logger.error('Skip line {} of {}: {}'.format(lineno, input_path, e))
+                continue
+            rid = request_id(request, lineno)
+            if rid not in done:
+                yield rid, request
+
+def locate_stops(app, advise):
+    # [[{'location': ..., 'point': 'lon,lat' or None}, ...] per day]
+    days = advise['days']
+    addresses = [sch['location'] for day in days for sch in day['schedule']]
+    loclists = iter(app.wg_geo.get_locations(addresses, advise['adcode']))
+    return [[
+        {'location': sch['location'],
+         'point': str(loclist[0]) if loclist else None}
+        for sch, loclist in zip(day['schedule'], loclists)
+    ] for day in days]
+
+def plan_trip(app, rid, request):
+    # Every worker is a session of its own for the stage scheduler.
+    app.current_session.set(threading.current_thread().name)
+    start = time.perf_counter()
+    result = {'id': rid, 'request': request, 'error': None}
+    try:
+        brief = app.create_trip_brief(
+            request['city'], int(request['days']), request['first_date'])
+        result['brief'] = brief
+        if not brief:
+            result['error'] = 'no brief'
+            return result
+
+        advise = app.generate_trip_advise(brief)
+        result['advise'] = advise
+        if not advise:
+            result['error'] = 'no advise'
+            return result
+
+        result['locations'] = locate_stops(app, advise)
+    except Exception as e:
+        logger.error('Plan trip {} failed: {}'.format(rid, e))
+        result['error'] = str(e) or e.__class__.__name__
+    finally:
+        result['seconds'] = time.perf_counter() - start
+    return result
+
+class ResultWriter(object):
+    # Appends results to the output as they finish, flushed line by line.
+
+    def __init__(self, output_path, append):
+        mode = 'a' if append else 'w'
+        self.f = open(output_path, mode, encoding='utf-8')
+        # Start on a new line after one cut off by an interrupted run.
+        if append and self.f.tell() > 0:
+            with open(output_path, 'rb') as f:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b'\n':
+                    self.f.write('\n')
+        self.ok, self.failed = 0, 0
+        self._lock = threading.Lock()
+
+    def write(self, result):
+        # Dates of the brief are written as ISO strings.
+        line = json.dumps(result, ensure_ascii=False, default=str)
+        with self._lock:
+            self.f.write(line + '\n')
+            self.f.flush()
+            if result['error']:
+                self.failed += 1
+            else:
+                self.ok += 1
+
+    def close(self):
+        self.f.close()
+
+def run(app, input_path, output_path, workers, resume):
+    done = read_done_ids(output_path) if resume else set()
+    if done:
+        logger.info(f'Skip {len(done)} trips planned before.')
+
+    writer = ResultWriter(output_path, append=resume)
+    # At most two requests per worker are read ahead.
+    slots = threading.BoundedSemaphore(2 * workers)
+
+    def _finish(future):
+        try:
+            writer.write(future.result())
+        except Exception as e:
+            logger.error('Write result failed: {}'.format(e))
+        finally:
+            slots.release()
+
+    start = time.perf_counter()
+    try:
+        with ThreadPoolExecutor(max_workers=workers,
+                                thread_name_prefix='wego-batch') as executor:
+            for rid, request in iter_requests(input_path, done):
+                slots.acquire()
+                future = executor.submit(plan_trip, app, rid, request)
+                future.add_done_callback(_finish)
+    finally:
+        writer.close()
+
+    logger.info('Planned {} trips, {} failed, in {:.1f}s.'.format(
+        writer.ok, writer.failed, time.perf_counter() - start))
+    return writer.failed
+
+def main():
+    parser = argparse.ArgumentParser(description='Plan trips in batch.')
+    parser.add_argument('input', help='JSONL of trip requests')
+    parser.add_argument('--output', required=True, help='JSONL of results')
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--rate', action='append', default=[],
+                        help='calls per second to a provider, e.g. gaode=50,'
+                             ' among gaode, yi, intern and qwen')
+    parser.add_argument('--resume', action='store_true',
+                        help='keep the output and skip trips planned in it')
+    args = parser.parse_args()
+
+    import app
+
+    try:
+        limits = parse_rates(args.rate, provider_urls(app))
+    except ValueError as e:
+        parser.error(str(e))
+    for url, rate in limits.items():
+        app.wg_http.limit_rate(url, rate)
+
+    failed = run(app, args.input, args.output, args.workers, args.resume)
+    app.wg_executor.shutdown(wait=False)
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# File              : bench_startup.py
+# Author            : Yan <yanwong@126.com>
+# Date              : 17.10.2026
+# Last Modified Date: 17.10.2026
+# Last Modified By  : Yan <yanwong@126.com>
+
+# Measures how long importing app takes in a fresh interpreter, which is
+# most of the time a replica needs to become ready, and checks it stays
+# within a budget. For example:
+#
+#   python benchmark/bench_startup.py --runs 5 --budget 6
+#
+# Exits with 1 when the median import time is over the budget or a
+# provider SDK or plotly was imported at start. tests/test_startup.py runs
+# the same check once.
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(BENCHMARK_DIR)
+
+from bench_trip import setup_env
+
+# Only imported on the first generation, see LazyTripAdvisor, or on the
+# first map, see map_util.map_template.
+LAZY_MODULES = ['dashscope', 'openxlab', 'plotly']
+# Seconds importing app may take.
+STARTUP_BUDGET = 6.0
+
+IMPORT_APP = '''
+import json, sys, time
+start = time.perf_counter()
+import app
+elapsed = time.perf_counter() - start
+print(json.dumps({'seconds': elapsed,
+                  'loaded': [m for m in %r if m in sys.modules]}))
+''' % (LAZY_MODULES, )
+
+def parse_importtime(stderr, top_n):
+    # Lines of -X importtime look like
+    # "import time: self [us] | cumulative | imported package".
+    modules = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        # Only modules imported by app itself, not their dependencies.
+        if name.startswith('   ') and not name.startswith('     '):
+            modules.append((name.strip(), int(cumulative) / 1e6))
+    return sorted(modules, key=lambda m: -m[1])[:top_n]
+
+def import_app(env, importtime=False):
+    cmd = [sys.executable] + (['-X', 'importtime'] if importtime else []) + \
+        ['-c', IMPORT_APP]
+    proc = subprocess.run(cmd, cwd=ROOT_DIR, env=env, capture_output=True,
+                          text=True)
+    if proc.returncode != 0:
+        raise RuntimeError('Import app failed:\n' + proc.stderr)
+    return json.loads(proc.stdout.strip().splitlines()[-1]), proc.stderr
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure start time of WeGo.')
+    parser.add_argument('--runs', type=int, default=3)
+    parser.add_argument('--budget', type=float, default=STARTUP_BUDGET,
+                        help='seconds the median import may take')
+    parser.add_argument('--backends', default='yi,qwen,intern')
+    parser.add_argument('--top', type=int, default=10,
+                        help='show the slowest modules imported by app')
+    args = parser.parse_args()
+
+    # Nothing listens here, any call made at start fails instead of
+    # reaching a real service.
+    setup_env('http://127.0.0.1:9', args.backends,
+              tempfile.mkdtemp(prefix='wego-startup-'))
+    env = dict(os.environ)
+
+    results = [import_app(env)[0] for _ in range(args.runs)]
+    seconds = [r['seconds'] for r in results]
+    loaded = sorted(set(m for r in results for m in r['loaded']))
+    _, stderr = import_app(env, importtime=True)
+
+    median = statistics.median(seconds)
+    print('import app: median {:.2f}s, min {:.2f}s, max {:.2f}s over {} runs,'
+          ' budget {:.2f}s'.format(median, min(seconds), max(seconds),
+                                   args.runs, args.budget))
+    for name, cumulative in parse_importtime(stderr, args.top):
+        print('{:<28}{:>8.3f}s'.format(name, cumulative))
+
+    failed = False
+    if median > args.budget:
+        print('Over budget by {:.2f}s.'.format(median - args.budget))
+        failed = True
+    if loaded:
+        print('Imported at start: {}'.format(', '.join(loaded)))
+        failed = True
+    sys.exit(1 if failed else 0)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# File              : bench_trip.py
+# Author            : Yan <yanwong@126.com>
+# Date              : 17.10.2026
+# Last Modified Date: 17.10.2026
+# Last Modified By  : Yan <yanwong@126.com>
+
+# Measures how long trips take end to end and per stage, offline, against
+# the stub servers of stub_servers.py. For example:
+#
+#   python benchmark/bench_trip.py --trips 200 --concurrency 16 \
+#       --backends yi,qwen --latency-scale 0.2 --output bench.json
+#
+# Every run starts with empty caches in a temporary directory, so the
+# share of cache hits only depends on how often the workload repeats trips.
+
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, timedelta
+import json
+import logging
+import math
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCHMARK_DIR))
+
+from stub_servers import StubServer, PAYLOADS_PATH, LATENCY_PATH
+
+STAGES = ['create_trip_brief', 'generate_trip_advise', 'mark_advise_on_map',
+          'highlight_advise', 'total']
+
+def percentile(values, p):
+    values = sorted(values)
+    if not values:
+        return None
+    k = min(len(values) - 1, max(0, math.ceil(p * len(values)) - 1))
+    return values[k]
+
+def setup_env(stub_url, backends, cache_dir):
+    # app reads its configuration at import, so this must run before it.
+    os.environ.update({
+        'WEGO_GAODE_HOST': stub_url,
+        'WEGO_INTERNLM_HOST': stub_url,
+        'WEGO_OPENXLAB_HOST': stub_url,
+        'WEGO_BAIDU_HOST': stub_url,
+        'WEGO_BILIBILI_HOST': stub_url,
+        'DASHSCOPE_HTTP_BASE_URL': stub_url + '/api/v1',
+        'WEGO_CACHE_DIR': cache_dir,
+        'WEGO_TRIP_ADVISORS': backends,
+        'WEGO_FORECAST_PREFETCH_TOP_N': '0',
+        'WEGO_VIDEO_PREFETCH_TOP_N': '0',
+    })
+    for key in ['GAODE_API_KEY', 'BILIBILI_SESSDATA', 'DASHSCOPE_API_KEY',
+                'BAIDU_API_KEY', 'BAIDU_SK', 'OPENXLAB_AK', 'OPENXLAB_SK']:
+        os.environ.setdefault(key, 'benchmark')
+
+def make_trips(num_trips, cities, max_days, seed):
+    rng = random.Random(seed)
+    today = date.today()
+    return [(
+        rng.choice(cities),
+        rng.randint(1, max_days),
+        (today + timedelta(days=rng.randint(0, 1))).isoformat()
+    ) for _ in range(num_trips)]
+
+def run_trip(app, trip):
+    city, days, first_date = trip
+    # Every worker stands for a user of its own, so the stages share their
+    # slots among them.
+    app.current_session.set(threading.current_thread().name)
+    timings = {}
+    start = time.perf_counter()
+
+    t = time.perf_counter()
+    brief = app.create_trip_brief(city, days, first_date)
+    timings['create_trip_brief'] = time.perf_counter() - t
+    if not brief:
+        return timings, 'no brief'
+
+    t = time.perf_counter()
+    advise = app.generate_trip_advise(brief)
+    timings['generate_trip_advise'] = time.perf_counter() - t
+    if not advise:
+        return timings, 'no advise'
+
+    t = time.perf_counter()
+    app.mark_advise_on_map(advise)
+    timings['mark_advise_on_map'] = time.perf_counter() - t
+
+    t = time.perf_counter()
+    app.highlight_advise(brief, advise)
+    timings['highlight_advise'] = time.perf_counter() - t
+
+    timings['total'] = time.perf_counter() - start
+    return timings, None
+
+def summarize(results, wall_time):
+    report = {'trips': len(results), 'wall_time_s': wall_time, 'stages': {}}
+    errors = {}
+    for timings, error in results:
+        if error:
+            errors[error] = errors.get(error, 0) + 1
+    report['errors'] = errors
+    for stage in STAGES:
+        values = [t[stage] for t, _ in results if stage in t]
+        report['stages'][stage] = {
+            'count': len(values),
+            'mean_ms': 1000 * sum(values) / len(values) if values else None,
+            'p50_ms': 1000 * percentile(values, 0.5) if values else None,
+            'p95_ms': 1000 * percentile(values, 0.95) if values else None,
+            'p99_ms': 1000 * percentile(values, 0.99) if values else None,
+        }
+    report['throughput_trips_per_s'] = len(results) / wall_time if wall_time else None
+    return report
+
+def print_report(report):
+    print('{} trips in {:.2f}s, {:.2f} trips/s, errors: {}'.format(
+        report['trips'], report['wall_time_s'],
+        report['throughput_trips_per_s'] or 0, report['errors'] or 'none'))
+    print('{:<22}{:>8}{:>12}{:>12}{:>12}{:>12}'.format(
+        'stage', 'count', 'mean(ms)', 'p50(ms)', 'p95(ms)', 'p99(ms)'))
+    for stage, s in report['stages'].items():
+        if not s['count']:
+            continue
+        print('{:<22}{:>8}{:>12.1f}{:>12.1f}{:>12.1f}{:>12.1f}'.format(
+            stage, s['count'], s['mean_ms'], s['p50_ms'], s['p95_ms'],
+            s['p99_ms']))
+    for name, stats in report.get('caches', {}).items():
+        print('{} cache: {}'.format(name, stats))
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark WeGo trips offline.')
+    parser.add_argument('--trips', type=int, default=50)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--backends', default='yi',
+                        help='comma separated among qwen, intern and yi')
+    parser.add_argument('--max-days', type=int, default=4)
+    parser.add_argument('--payloads', default=PAYLOADS_PATH)
+    parser.add_argument('--latency', default=LATENCY_PATH)
+    parser.add_argument('--latency-scale', type=float, default=1.0,
+                        help='multiplies every latency of the stub servers')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='write the report as JSON')
+    parser.add_argument('--verbose', action='store_true')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.ERROR)
+
+    server = StubServer(payloads_path=args.payloads, latency_path=args.latency,
+                        latency_scale=args.latency_scale, seed=args.seed).start()
+    cache_dir = tempfile.mkdtemp(prefix='wego-bench-')
+    setup_env(server.url, args.backends, cache_dir)
+
+    import app
+    if not args.verbose:
+        logging.getLogger().setLevel(logging.ERROR)
+
+    trips = make_trips(args.trips, list(server.payloads.cities),
+                       args.max_days, args.seed)
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        results = list(executor.map(lambda trip: run_trip(app, trip), trips))
+    wall_time = time.perf_counter() - start
+    server.stop()
+
+    report = summarize(results, wall_time)
+    report['config'] = {
+        'trips': args.trips, 'concurrency': args.concurrency,
+        'backends': args.backends, 'latency_scale': args.latency_scale,
+        'seed': args.seed
+    }
+    report['caches'] = {
+        'location': app.wg_location_cache.stats(),
+        'advise': app.wg_advise_cache.stats(),
+        'map': app.wg_map_cache.stats()
+    }
+    report['stages_admission'] = app.wg_scheduler.stats()
+    print_report(report)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,309 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# File              : stub_servers.py
+# Author            : Yan <yanwong@126.com>
+# Date              : 17.10.2026
+# Last Modified Date: 17.10.2026
+# Last Modified By  : Yan <yanwong@126.com>
+
+# Local stand-ins for every external service WeGo calls: Gaode geocode,
+# POI, weather and staticmap, bilibili search, the dashscope (Qwen), puyu
+# (InternLM) and wenxinworkshop (Yi) completion endpoints, and the Baidu
+# and openxlab token endpoints. Responses
+# are built from the recorded payloads.json and delayed according to the
+# latency distributions of latency.json.
+
+import base64
+from datetime import date, datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import logging
+import os
+import random
+import re
+import threading
+import time
+from urllib.parse import parse_qs, urlparse
+
+logger = logging.getLogger(__name__)
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+PAYLOADS_PATH = os.path.join(BENCHMARK_DIR, 'payloads.json')
+LATENCY_PATH = os.path.join(BENCHMARK_DIR, 'latency.json')
+
+# 1x1 transparent png, the staticmap stand-in.
+STATICMAP_PNG = base64.b64decode(
+    'iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAQAAAC1HAwCAAAAC0lEQVR42mNkYAAAAAYAAjCB0C8AAAAASUVORK5CYII=')
+
+class LatencyModel(object):
+    # Lognormal latencies around a median, per service. LLM services also
+    # stream their output in chunks of chunk_chars every chunk_ms.
+
+    def __init__(self, latencies, scale=1.0, seed=None):
+        self.latencies = latencies
+        self.scale = scale
+        self.random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def sample(self, service):
+        conf = self.latencies.get(service, {})
+        median = conf.get('median_ms', 0) / 1000
+        with self._lock:
+            latency = median * self.random.lognormvariate(0, conf.get('sigma', 0))
+        return latency * self.scale
+
+    def chunk(self, service):
+        conf = self.latencies.get(service, {})
+        return conf.get('chunk_ms', 0) / 1000 * self.scale, \
+            conf.get('chunk_chars', 16)
+
+class TripPayloads(object):
+    def __init__(self, payloads):
+        self.cities = payloads['cities']
+        self.times = payloads['times']
+        self.description = payloads['description']
+        self.videos = payloads['videos']
+        self.places = {}  # name -> (city, geocode)
+        for city, data in self.cities.items():
+            self.places[city] = (city, data['geocode'])
+            for name, location in data['attractions']:
+                geocode = dict(data['geocode'], location=location,
+                               formatted_address=data['geocode']['formatted_address'] + name)
+                self.places[name] = (city, geocode)
+
+    def find_city(self, text):
+        for city in self.cities:
+            if city in (text or ''):
+                return city
+        return None
+
+    def geocode(self, address):
+        place = self.places.get(address.strip())
+        if place:
+            return place[1]
+        city = self.find_city(address)
+        return self.cities[city]['geocode'] if city else None
+
+    def forecast(self, adcode):
+        for city, data in self.cities.items():
+            if data['geocode']['adcode'] == adcode:
+                today = date.today()
+                casts = [{
+                    'date': (today + timedelta(days=i)).isoformat(),
+                    'dayweather': day, 'nightweather': night
+                } for i, (day, night) in enumerate(data['weathers'])]
+                return {'city': city, 'adcode': adcode, 'casts': casts,
+                        'reporttime': datetime.now().strftime('%Y-%m-%d %H:00:00')}
+        return None
+
+    def advise(self, prompt):
+        # Plans the trip described at the end of the prompt, or only the
+        # days asked for by a repair request.
+        brief = prompt[prompt.rfind('目的地:'):]
+        city = self.find_city(brief.split('\n')[0]) or next(iter(self.cities))
+        m = re.search(r'旅游天数:(\d+)天', brief)
+        num_days = int(m.group(1)) if m else 1
+        repair = re.search(r'请你只制定(.+?)的行程', brief)
+        wanted = [int(d) - 1 for d in re.findall(r'第(\d+)天', repair.group(1))] \
+            if repair else list(range(num_days))
+
+        attractions = self.cities[city]['attractions']
+        per_day = max(1, min(3, len(attractions) // num_days))
+        days = []
+        for i in wanted:
+            stops = attractions[i * per_day:(i + 1) * per_day] or attractions[-1:]
+            days.append({
+                'date': f'第{i+1}天',
+                'schedule': [{
+                    'time': self.times[k * 2 % len(self.times)],
+                    'location': name,
+                    'description': self.description.format(location=name, city=city)
+                } for k, (name, _) in enumerate(stops)]
+            })
+        if repair:
+            return json.dumps({'days': days}, ensure_ascii=False)
+        return json.dumps({'city': city, 'days': days}, ensure_ascii=False)
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+    def _send(self, body, content_type='application/json;charset=UTF-8',
+              status=200):
+        if isinstance(body, (dict, list)):
+            body = json.dumps(body, ensure_ascii=False)
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_stream(self, service, events):
+        # Server-sent events, one chunk of the output every chunk_ms.
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream;charset=UTF-8')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        interval, _ = self.server.latency.chunk(service)
+        for event in events:
+            self.wfile.write(event.encode('utf-8'))
+            self.wfile.flush()
+            time.sleep(interval)
+        self.close_connection = True
+
+    def _delay(self, service):
+        time.sleep(self.server.latency.sample(service))
+
+    def _chunks(self, service, text):
+        _, size = self.server.latency.chunk(service)
+        return [text[i:i + size] for i in range(0, len(text), size)]
+
+    def _llm_delay(self, service, text):
+        # Time to the first token plus generating the rest of the text.
+        interval, size = self.server.latency.chunk(service)
+        time.sleep(self.server.latency.sample(service) +
+                   interval * (len(text) // size))
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        params = {k: v[0] for k, v in parse_qs(url.query).items()}
+        payloads = self.server.payloads
+
+        if url.path == '/v3/geocode/geo':
+            self._delay('gaode_geocode')
+            addresses = params.get('address', '')
+            addresses = addresses.split('|') if params.get('batch') == 'true' \
+                else [addresses]
+            empty = {'formatted_address': [], 'province': [], 'city': [],
+                     'citycode': [], 'adcode': [], 'location': []}
+            geocodes = [payloads.geocode(a) for a in addresses]
+            if params.get('batch') != 'true':
+                geocodes = [g for g in geocodes if g]
+            self._send({
+                'status': '1', 'info': 'OK', 'count': str(len(geocodes)),
+                'geocodes': [g or empty for g in geocodes]
+            })
+        elif url.path == '/v3/place/text':
+            self._delay('gaode_poi')
+            if params.get('types'):
+                city = next((c for c, d in payloads.cities.items()
+                             if d['geocode']['adcode'] == params.get('city')), None)
+                pois = [{'name': n, 'location': loc}
+                        for n, loc in payloads.cities[city]['attractions']] \
+                    if city and params.get('page', '1') == '1' else []
+            else:
+                geocode = payloads.geocode(params.get('keywords', ''))
+                pois = [{'name': params.get('keywords'),
+                         'location': geocode['location']}] if geocode else []
+            self._send({'status': '1', 'info': 'OK', 'pois': pois})
+        elif url.path == '/v3/weather/weatherInfo':
+            self._delay('gaode_weather')
+            forecast = payloads.forecast(params.get('city'))
+            self._send({'status': '1', 'info': 'OK',
+                        'forecasts': [forecast] if forecast else []})
+        elif url.path == '/v3/staticmap':
+            self._delay('gaode_staticmap')
+            self._send(STATICMAP_PNG, content_type='image/png')
+        elif url.path == '/x/web-interface/search/all/v2':
+            self._delay('bilibili_search')
+            videos = payloads.videos if payloads.find_city(params.get('keyword')) else []
+            self._send({'code': 0, 'data': {'result': [
+                {'result_type': 'video', 'data': videos}]}})
+        else:
+            self._send({'error': 'not found'}, status=404)
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else b''
+        request = json.loads(body) if body else {}
+        payloads = self.server.payloads
+
+        if url.path == '/oauth/2.0/token':
+            self._delay('baidu_auth')
+            self._send({'access_token': 'benchmark', 'expires_in': 2592000})
+        elif url.path.startswith('/api/v1/sso-be/api/v1/open/'):
+            # The nonce signing is not checked, any keys get a token.
+            self._delay('openxlab_auth')
+            if url.path.endswith('/auth'):
+                data = {'nonce': 'benchmark', 'algorithm': 'HmacSHA256'}
+            else:
+                expiration = (datetime.now() + timedelta(days=1)).strftime(
+                    '%Y-%m-%d %H:%M:%S')
+                data = {'jwt': 'benchmark', 'expiration': expiration,
+                        'sso_uid': 'benchmark', 'refresh_token': 'benchmark',
+                        'refresh_expiration': expiration}
+            self._send({'msgCode': '10000', 'msg': 'ok', 'data': {
+                'msgCode': '10000', 'msg': 'ok', 'data': data}})
+        elif url.path.endswith('/wenxinworkshop/chat/yi_34b_chat'):
+            prompt = request['messages'][-1]['content']
+            text = payloads.advise(prompt)
+            usage = {'prompt_tokens': len(prompt), 'completion_tokens': len(text)}
+            if request.get('stream'):
+                self._delay('yi')
+                chunks = self._chunks('yi', text)
+                self._send_stream('yi', [
+                    'data: ' + json.dumps({
+                        'result': c, 'is_end': i == len(chunks) - 1,
+                        'usage': usage
+                    }, ensure_ascii=False) + '\n\n'
+                    for i, c in enumerate(chunks)])
+            else:
+                self._llm_delay('yi', text)
+                self._send({'result': text, 'is_end': True, 'usage': usage})
+        elif url.path == '/puyu/api/v1/chat/completion':
+            text = payloads.advise(request['messages'][-1]['text'])
+            self._llm_delay('intern', text)
+            self._send({'msg': 'ok', 'code': 0,
+                        'data': {'choices': [{'text': text}]}})
+        elif url.path.endswith('/services/aigc/text-generation/generation'):
+            messages = request['input']['messages']
+            text = payloads.advise(messages[-1]['content'])
+            usage = {'input_tokens': sum(len(m['content']) for m in messages),
+                     'output_tokens': len(text)}
+            if self.headers.get('X-DashScope-SSE') == 'enable':
+                self._delay('qwen')
+                self._send_stream('qwen', [
+                    'id:{}\nevent:result\n:HTTP_STATUS/200\ndata:{}\n\n'.format(
+                        i, json.dumps({
+                            'output': {'text': c, 'finish_reason': 'null'},
+                            'usage': usage, 'request_id': 'benchmark'
+                        }, ensure_ascii=False))
+                    for i, c in enumerate(self._chunks('qwen', text))])
+            else:
+                self._llm_delay('qwen', text)
+                self._send({'output': {'text': text, 'finish_reason': 'stop'},
+                            'usage': usage, 'request_id': 'benchmark'})
+        else:
+            self._send({'error': 'not found'}, status=404)
+
+class StubServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address=('127.0.0.1', 0), payloads_path=PAYLOADS_PATH,
+                 latency_path=LATENCY_PATH, latency_scale=1.0, seed=None):
+        super().__init__(address, StubHandler)
+        with open(payloads_path, encoding='utf-8') as f:
+            self.payloads = TripPayloads(json.load(f))
+        with open(latency_path, encoding='utf-8') as f:
+            self.latency = LatencyModel(json.load(f), latency_scale, seed)
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def start(self):
+        self._thread = threading.Thread(
+            target=self.serve_forever, name='stub-server', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
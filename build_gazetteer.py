@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# File              : build_gazetteer.py
+# Author            : Yan <yanwong@126.com>
+# Date              : 17.10.2026
+# Last Modified Date: 17.10.2026
+# Last Modified By  : Yan <yanwong@126.com>
+
+# Builds the offline attraction gazetteer read by gazetteer_util.Gazetteer.
+# Attractions come from the location cache filled by past trips and,
+# optionally, from Gaode POI search of the given cities, e.g.
+#
+#   python build_gazetteer.py --from-cache cache/location.db \
+#       --poi-adcodes 330100 110000 --poi-pages 10
+
+import argparse
+import json
+import logging
+import os
+import re
+import sqlite3
+
+from gazetteer_util import normalize_name
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(message)s'
+)
+
+logger = logging.getLogger(__name__)
+
+GAODE_GEOCODE_URL = 'https://restapi.amap.com/v3/geocode/geo'
+GAODE_POI_URL = 'https://restapi.amap.com/v3/place/text'
+GAODE_STATICMAP_URL = 'https://restapi.amap.com/v3/staticmap'
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+
+def add_attraction(cities, adcode, name, location):
+    try:
+        lon, lat = [float(v) for v in location.split(',')]
+    except (AttributeError, ValueError):
+        return
+    city = cities.setdefault(adcode, {})
+    city.setdefault(normalize_name(name), (name, lon, lat))
+
+def collect_from_cache(cities, cache_path, table='location'):
+    conn = sqlite3.connect(cache_path)
+    count = 0
+    for key, value in conn.execute(f'SELECT key, value FROM {table}'):
+        address, city = json.loads(key)
+        locations = json.loads(value)
+        # Only lookups of trip plans are keyed by a 6 digit adcode.
+        if re.fullmatch(r'\d{6}', city) and locations:
+            add_attraction(cities, city, address, locations[0])
+            count += 1
+    conn.close()
+    logger.info(f'Collected {count} attractions from {cache_path}')
+
+def collect_from_poi(cities, adcodes, pages):
+    from map_util import GaodeGeo
+
+    geo = GaodeGeo(GAODE_GEOCODE_URL, GAODE_POI_URL, GAODE_STATICMAP_URL)
+    for adcode in adcodes:
+        count = 0
+        for page in range(1, pages + 1):
+            attractions = geo.search_attractions(adcode, page=page)
+            if not attractions:
+                break
+            for a in attractions:
+                add_attraction(cities, adcode, a['name'], a['location'])
+            count += len(attractions)
+        logger.info(f'Collected {count} attractions of {adcode} from Gaode')
+
+def to_columns(city):
+    names, lons, lats = [], [], []
+    for name, lon, lat in sorted(city.values()):
+        names.append(name)
+        lons.append(round(lon, 6))
+        lats.append(round(lat, 6))
+    return {'names': names, 'lons': lons, 'lats': lats}
+
+def main():
+    parser = argparse.ArgumentParser(description='Build attraction gazetteer.')
+    parser.add_argument('--output', default=os.path.join(DATA_DIR, 'gazetteer.json'))
+    parser.add_argument('--from-cache', help='location cache to harvest')
+    parser.add_argument('--poi-adcodes', nargs='*', default=[],
+                        help='cities to search attractions of on Gaode')
+    parser.add_argument('--poi-pages', type=int, default=10,
+                        help='pages of 25 attractions per city')
+    parser.add_argument('--aliases', help='csv of adcode,alias,name rows')
+    parser.add_argument('--merge', action='store_true',
+                        help='keep cities of the existing output file')
+    args = parser.parse_args()
+
+    cities = {}
+    aliases = {}
+    if args.merge and os.path.exists(args.output):
+        with open(args.output, encoding='utf-8') as f:
+            for adcode, city in json.load(f).items():
+                for i, name in enumerate(city['names']):
+                    add_attraction(cities, adcode, name,
+                                   f"{city['lons'][i]},{city['lats'][i]}")
+                aliases[adcode] = {
+                    alias: city['names'][i]
+                    for alias, i in city.get('aliases', {}).items()
+                }
+
+    if args.from_cache:
+        collect_from_cache(cities, args.from_cache)
+    if args.poi_adcodes:
+        collect_from_poi(cities, args.poi_adcodes, args.poi_pages)
+    if args.aliases:
+        with open(args.aliases, encoding='utf-8-sig') as f:
+            for line in f:
+                row = line.strip().split(',')
+                if len(row) == 3 and row[0].isdigit():
+                    aliases.setdefault(row[0], {})[row[1]] = row[2]
+
+    gazetteer = {}
+    for adcode, city in sorted(cities.items()):
+        columns = to_columns(city)
+        positions = {normalize_name(n): i for i, n in enumerate(columns['names'])}
+        city_aliases = {
+            alias: positions[normalize_name(name)]
+            for alias, name in aliases.get(adcode, {}).items()
+            if normalize_name(name) in positions
+        }
+        if city_aliases:
+            columns['aliases'] = city_aliases
+        gazetteer[adcode] = columns
+
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(gazetteer, f, ensure_ascii=False, separators=(',', ':'))
+    logger.info('Wrote {} attractions of {} cities to {}'.format(
+        sum(len(c['names']) for c in gazetteer.values()), len(gazetteer),
+        args.output))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# File              : cache_util.py
+# Author            : Yan <yanwong@126.com>
+# Date              : 17.10.2026
+# Last Modified Date: 17.10.2026
+# Last Modified By  : Yan <yanwong@126.com>
+
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+from metrics_util import CacheStats
+
+logger = logging.getLogger(__name__)
+
+class SqliteCache(CacheStats):
+    # A small key-value cache persisted in SQLite. Several app processes can
+    # share one database file: WAL mode lets readers run alongside a writer,
+    # and every thread gets its own connection. Entries expire after ttl
+    # seconds and the least recently used ones are evicted once the table
+    # grows beyond max_entries. Eviction runs every evict_every writes, or
+    # sooner when the estimated size crosses max_entries, not on every write.
+    # A hit only refreshes the access time of an entry last touched more
+    # than touch_interval seconds ago, so most reads do not write.
+
+    def __init__(self, path, table='cache', ttl=30 * 24 * 3600,
+                 max_entries=100000, busy_timeout=5.0, evict_every=500,
+                 touch_interval=60):
+        self.path = path
+        self.table = table
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.busy_timeout = busy_timeout
+        self.evict_every = evict_every
+        self.touch_interval = touch_interval
+        self._local = threading.local()
+        self._evict_lock = threading.Lock()
+        self._writes = 0
+        self.hits = 0
+        self.misses = 0
+
+        cache_dir = os.path.dirname(os.path.abspath(path))
+        os.makedirs(cache_dir, exist_ok=True)
+
+        conn = self._conn()
+        with conn:
+            conn.execute(
+                f'CREATE TABLE IF NOT EXISTS {self.table} ('
+                'key TEXT PRIMARY KEY, value TEXT NOT NULL, '
+                'created REAL NOT NULL, accessed REAL NOT NULL)'
+            )
+            conn.execute(
+                f'CREATE INDEX IF NOT EXISTS {self.table}_accessed '
+                f'ON {self.table} (accessed)'
+            )
+            conn.execute(
+                f'CREATE INDEX IF NOT EXISTS {self.table}_created '
+                f'ON {self.table} (created)'
+            )
+        # Counts every write as a new entry, so it never underestimates what
+        # this process added. Other processes are caught by the periodic
+        # eviction.
+        self._estimated = len(self)
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=self.busy_timeout)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    @staticmethod
+    def make_key(*parts):
+        return json.dumps(parts, ensure_ascii=False)
+
+    def get(self, key):
+        now = time.time()
+        try:
+            conn = self._conn()
+            row = conn.execute(
+                f'SELECT value, created, accessed FROM {self.table} '
+                'WHERE key = ?', (key,)
+            ).fetchone()
+            if not row:
+                self.misses += 1
+                return None
+
+            value, created, accessed = row
+            if now - created > self.ttl:
+                with conn:
+                    conn.execute(
+                        f'DELETE FROM {self.table} WHERE key = ?', (key,))
+                self.misses += 1
+                return None
+            if now - accessed > self.touch_interval:
+                with conn:
+                    conn.execute(
+                        f'UPDATE {self.table} SET accessed = ? WHERE key = ?',
+                        (now, key)
+                    )
+            self.hits += 1
+            return json.loads(value)
+        except Exception as e:
+            logger.error('Read cache {} failed: {}'.format(self.path, e))
+        self.misses += 1
+        return None
+
+    def set(self, key, value):
+        now = time.time()
+        try:
+            conn = self._conn()
+            with conn:
+                conn.execute(
+                    f'INSERT OR REPLACE INTO {self.table} '
+                    '(key, value, created, accessed) VALUES (?, ?, ?, ?)',
+                    (key, json.dumps(value, ensure_ascii=False), now, now)
+                )
+                if self._should_evict():
+                    self._evict(conn, now)
+        except Exception as e:
+            logger.error('Write cache {} failed: {}'.format(self.path, e))
+
+    def _should_evict(self):
+        with self._evict_lock:
+            self._writes += 1
+            self._estimated += 1
+            if self._writes < self.evict_every and \
+                    self._estimated <= self.max_entries:
+                return False
+            self._writes = 0
+            return True
+
+    def _evict(self, conn, now):
+        conn.execute(
+            f'DELETE FROM {self.table} WHERE created < ?', (now - self.ttl,))
+        count = conn.execute(f'SELECT COUNT(*) FROM {self.table}').fetchone()[0]
+        if count > self.max_entries:
+            # Leave room for a tenth more, so a full cache is not evicted
+            # again on the next write.
+            keep = self.max_entries - self.max_entries // 10
+            conn.execute(
+                f'DELETE FROM {self.table} WHERE key IN ('
+                f'SELECT key FROM {self.table} ORDER BY accessed LIMIT ?)',
+                (count - keep,)
+            )
+            count = keep
+        with self._evict_lock:
+            self._estimated = count
+
+    def __len__(self):
+        return self._conn().execute(
+            f'SELECT COUNT(*) FROM {self.table}').fetchone()[0]
@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# File              : city_util.py
+# Author            : Yan <yanwong@126.com>
+# Date              : 17.10.2026
+# Last Modified Date: 17.10.2026
+# Last Modified By  : Yan <yanwong@126.com>
+
+import csv
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Longer suffixes go first so that 广西壮族自治区 is stripped to 广西
+# rather than 广西壮族自治.
+ADMIN_SUFFIXES = [
+    '维吾尔自治区', '壮族自治区', '回族自治区', '特别行政区',
+    '自治区', '自治州', '自治县', '自治旗',
+    '地区', '新区', '林区', '省', '市', '县', '区', '盟', '旗'
+]
+
+MUNICIPALITY_PREFIXES = ('11', '12', '31', '50')
+
+def strip_admin_suffix(name):
+    for suffix in ADMIN_SUFFIXES:
+        if name.endswith(suffix) and len(name) - len(suffix) >= 2:
+            return name[:-len(suffix)]
+    return name
+
+class CityIndex(object):
+    # Resolves Chinese administrative division names to Gaode geocodes
+    # offline, using the name/adcode/citycode table shipped in data/.
+    # Adcodes are 6 digits: 2 for province, 2 for city and 2 for district.
+
+    LEVEL_PROVINCE, LEVEL_CITY, LEVEL_DISTRICT = 0, 1, 2
+
+    def __init__(self, geocode_path):
+        self.divisions = {}  # adcode -> (name, citycode)
+        self.by_name = {}
+        self.by_stripped_name = {}
+        self.province_of = {}
+        self.city_of = {}
+
+        with open(geocode_path, encoding='utf-8-sig') as f:
+            reader = csv.reader(f)
+            next(reader)  # skip header
+            for row in reader:
+                if len(row) < 2 or not row[1].isdigit():
+                    continue
+                name, adcode = row[0].strip(), row[1].strip()
+                citycode = row[2].strip() if len(row) > 2 else ''
+                # Renamed divisions (e.g. 米林县 -> 米林市) keep the adcode,
+                # the latter row wins as the canonical name.
+                self.divisions[adcode] = (name, citycode or None)
+                self.by_name.setdefault(name, []).append(adcode)
+                self.by_stripped_name.setdefault(
+                    strip_admin_suffix(name), []).append(adcode)
+
+        for adcode in self.divisions:
+            province = adcode[:2] + '0000'
+            city = adcode[:4] + '00'
+            self.province_of[adcode] = province
+            # Municipalities and county-level divisions directly under a
+            # province have no city level, they belong to the province.
+            if adcode.startswith(MUNICIPALITY_PREFIXES) or \
+                    city not in self.divisions:
+                self.city_of[adcode] = province
+            else:
+                self.city_of[adcode] = city
+
+        logger.info(f'Loaded {len(self.divisions)} divisions from {geocode_path}')
+
+    def level(self, adcode):
+        if adcode.endswith('0000'):
+            return CityIndex.LEVEL_PROVINCE
+        if adcode.endswith('00'):
+            return CityIndex.LEVEL_CITY
+        return CityIndex.LEVEL_DISTRICT
+
+    def _to_geocode(self, adcode):
+        name, citycode = self.divisions[adcode]
+        province_adcode = self.province_of[adcode]
+        province_name = self.divisions[province_adcode][0]
+        city_adcode = self.city_of[adcode]
+
+        parts = [province_name]
+        if city_adcode != province_adcode:
+            city_name = self.divisions[city_adcode][0]
+            parts.append(city_name)
+        elif adcode.startswith(MUNICIPALITY_PREFIXES):
+            city_name = province_name
+        elif adcode != province_adcode:
+            city_name = name
+        else:
+            city_name = None
+        if name not in parts:
+            parts.append(name)
+
+        return {
+            'adcode': adcode,
+            'citycode': citycode,
+            'city': city_name,
+            'province': province_name,
+            'formatted_address': ''.join(parts)
+        }
+
+    def _lookup(self, name):
+        adcodes = self.by_name.get(name)
+        if adcodes:
+            return adcodes
+
+        adcodes = self.by_stripped_name.get(strip_admin_suffix(name))
+        if adcodes:
+            return adcodes
+
+        if len(name) >= 2:
+            adcodes = [
+                ad for n, ads in self.by_name.items() if n.startswith(name)
+                for ad in ads
+            ]
+        return adcodes or []
+
+    def resolve(self, name):
+        if not name:
+            return []
+        name = name.strip()
+        adcodes = list(dict.fromkeys(self._lookup(name)))
+        # Prefer higher levels when a name is ambiguous, e.g. 朝阳区 of
+        # Beijing and of Changchun are both districts and keep table order.
+        adcodes.sort(key=self.level)
+        return [self._to_geocode(ad) for ad in adcodes]
+
+    def same_province(self, code1, code2):
+        p1, p2 = self.province_of.get(code1), self.province_of.get(code2)
+        if p1 is None or p2 is None:
+            return str(code1)[:2] == str(code2)[:2]
+        return p1 == p2
+
+    def same_city(self, code1, code2):
+        c1, c2 = self.city_of.get(code1), self.city_of.get(code2)
+        if c1 is None or c2 is None:
+            return str(code1)[:4] == str(code2)[:4]
+        return c1 == c2
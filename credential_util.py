@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# File              : credential_util.py
+# Author            : Yan <yanwong@126.com>
+# Date              : 17.10.2026
+# Last Modified Date: 17.10.2026
+# Last Modified By  : Yan <yanwong@126.com>
+
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+class TokenManager(object):
+    # Caches an access token until it is about to expire. fetch_token must
+    # return (token, expires_at), expires_at being a unix timestamp or None
+    # when the provider does not tell. Within refresh_margin seconds of
+    # expiry the cached token is still handed out while a background thread
+    # fetches the next one; an expired token is refreshed synchronously and
+    # concurrent callers wait for that single fetch.
+
+    def __init__(self, name, fetch_token, refresh_margin=300, default_ttl=3600):
+        self.name = name
+        self.fetch_token = fetch_token
+        self.refresh_margin = refresh_margin
+        self.default_ttl = default_ttl
+
+        self._token = None
+        self._expires_at = 0
+        self._lock = threading.Lock()
+        self._refreshing = False
+
+    def _refresh(self):
+        token, expires_at = self.fetch_token()
+        if not token:
+            raise ValueError(f'{self.name} returned an empty token')
+        if expires_at is None:
+            expires_at = time.time() + self.default_ttl
+        self._token, self._expires_at = token, expires_at
+        logger.info('Refreshed {} token, expires in {:.0f}s'.format(
+            self.name, expires_at - time.time()))
+        return token
+
+    def _refresh_in_background(self):
+        def _run():
+            try:
+                with self._lock:
+                    if time.time() < self._expires_at - self.refresh_margin:
+                        return
+                    self._refresh()
+            except Exception as e:
+                logger.error('Refresh {} token failed: {}'.format(self.name, e))
+            finally:
+                self._refreshing = False
+
+        self._refreshing = True
+        threading.Thread(
+            target=_run, name=f'{self.name}-token-refresher', daemon=True
+        ).start()
+
+    def get_token(self):
+        now = time.time()
+        token, expires_at = self._token, self._expires_at
+        if token and now < expires_at:
+            if now >= expires_at - self.refresh_margin and not self._refreshing:
+                with self._lock:
+                    if not self._refreshing:
+                        self._refresh_in_background()
+            return token
+
+        with self._lock:
+            if self._token and time.time() < self._expires_at:
+                return self._token
+            return self._refresh()
+
+    def invalidate(self):
+        with self._lock:
+            self._token, self._expires_at = None, 0
@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# File              : gazetteer_util.py
+# Author            : Yan <yanwong@126.com>
+# Date              : 17.10.2026
+# Last Modified Date: 17.10.2026
+# Last Modified By  : Yan <yanwong@126.com>
+
+import json
+import logging
+import math
+import os
+import re
+import unicodedata
+
+logger = logging.getLogger(__name__)
+
+EARTH_RADIUS_KM = 6371.0
+
+# Generic words LLMs and Gaode add to or drop from attraction names,
+# e.g. 西湖风景名胜区 vs 西湖.
+ALIAS_SUFFIXES = ['风景名胜区', '风景区', '旅游区', '景区', '公园', '博物院', '博物馆']
+
+def normalize_name(name):
+    name = unicodedata.normalize('NFKC', name).strip().lower()
+    name = re.sub(r'\(.*?\)', '', name)  # 鲁迅故里(东门) -> 鲁迅故里
+    return re.sub(r'\s+', '', name)
+
+def name_aliases(name):
+    # The normalized name first, then the name without its generic suffix.
+    key = normalize_name(name)
+    aliases = [key]
+    for suffix in ALIAS_SUFFIXES:
+        if key.endswith(suffix) and len(key) - len(suffix) >= 2:
+            aliases.append(key[:-len(suffix)])
+            break
+    return aliases
+
+def haversine_km(lon1, lat1, lon2, lat2):
+    lon1, lat1, lon2, lat2 = map(math.radians, (lon1, lat1, lon2, lat2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + \
+        math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(math.sqrt(a))
+
+class Gazetteer(object):
+    # Attractions of every city known offline, loaded from the file written
+    # by build_gazetteer.py. The file stores, per adcode, the names and
+    # columnar lon/lat arrays plus extra aliases:
+    #   {"330100": {"names": [...], "lons": [...], "lats": [...],
+    #               "aliases": {"alias": index}}}
+    # Attractions are bucketed into a grid of cell_size degrees for
+    # nearby queries.
+
+    def __init__(self, path=None, cell_size=0.05):
+        self.cell_size = cell_size
+        self.cities = {}
+        if path and os.path.exists(path):
+            with open(path, encoding='utf-8') as f:
+                for adcode, city in json.load(f).items():
+                    self.add_city(adcode, city)
+            logger.info('Loaded gazetteer of {} cities from {}'.format(
+                len(self.cities), path))
+
+    def _cell(self, lon, lat):
+        return int(lon // self.cell_size), int(lat // self.cell_size)
+
+    def add_city(self, adcode, city):
+        # Exact names go first, then the aliases of the file, and names
+        # without their suffix last, so 中山 of 中山博物馆 never takes the
+        # place of an attraction named 中山.
+        index, grid = {}, {}
+        for i, name in enumerate(city['names']):
+            index.setdefault(normalize_name(name), i)
+            grid.setdefault(
+                self._cell(city['lons'][i], city['lats'][i]), []).append(i)
+        for alias, i in city.get('aliases', {}).items():
+            index.setdefault(normalize_name(alias), i)
+        for i, name in enumerate(city['names']):
+            for alias in name_aliases(name)[1:]:
+                index.setdefault(alias, i)
+        city['index'], city['grid'] = index, grid
+        self.cities[adcode] = city
+
+    def __contains__(self, adcode):
+        return adcode in self.cities
+
+    def lookup(self, name, adcode):
+        city = self.cities.get(adcode)
+        if not city:
+            return None
+        for alias in name_aliases(name):
+            i = city['index'].get(alias)
+            if i is not None:
+                return '{:.6f},{:.6f}'.format(city['lons'][i], city['lats'][i])
+        return None
+
+    def nearby(self, adcode, lon, lat, radius_km=5, limit=10):
+        # Attractions within radius_km of (lon, lat), nearest first.
+        city = self.cities.get(adcode)
+        if not city:
+            return []
+
+        lat_span = radius_km / 111.0
+        lon_span = radius_km / (111.0 * max(math.cos(math.radians(lat)), 0.01))
+        min_x, min_y = self._cell(lon - lon_span, lat - lat_span)
+        max_x, max_y = self._cell(lon + lon_span, lat + lat_span)
+
+        found = []
+        for x in range(min_x, max_x + 1):
+            for y in range(min_y, max_y + 1):
+                for i in city['grid'].get((x, y), []):
+                    dist = haversine_km(lon, lat, city['lons'][i], city['lats'][i])
+                    if dist <= radius_km:
+                        found.append((dist, i))
+        found.sort()
+        return [{
+            'name': city['names'][i],
+            'location': '{:.6f},{:.6f}'.format(city['lons'][i], city['lats'][i]),
+            'distance_km': dist
+        } for dist, i in found[:limit]]
@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# File              : http_util.py
+# Author            : Yan <yanwong@126.com>
+# Date              : 17.10.2026
+# Last Modified Date: 17.10.2026
+# Last Modified By  : Yan <yanwong@126.com>
+
+import logging
+import threading
+import time
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger(__name__)
+
+class RateLimiter(object):
+    # Token bucket, lets through rate calls per second on average and
+    # bursts of up to burst calls.
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst or max(1, rate)
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(
+                    self.burst, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+class HttpClient(object):
+    # A requests session shared by all external clients. urllib3 keeps one
+    # keep-alive connection pool per host, so consecutive calls to the same
+    # upstream skip the TCP and TLS handshakes. Every request gets a
+    # (connect, read) timeout unless the caller passes its own.
+
+    def __init__(self, connect_timeout=3.05, read_timeout=30,
+                 pool_connections=10, pool_maxsize=20):
+        self.timeout = (connect_timeout, read_timeout)
+        self.session = requests.Session()
+        # pool_connections: how many hosts keep a pool,
+        # pool_maxsize: how many connections each host pool keeps alive.
+        adapter = HTTPAdapter(
+            pool_connections=pool_connections, pool_maxsize=pool_maxsize
+        )
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.rate_limiters = {}  # host -> RateLimiter
+
+    def limit_rate(self, url, rate, burst=None):
+        # Calls to the host of url are held back to rate calls per second,
+        # e.g. to stay within the quota of a provider.
+        self.rate_limiters[urlparse(url).netloc] = RateLimiter(rate, burst)
+
+    def throttle(self, url):
+        limiter = self.rate_limiters.get(urlparse(url).netloc)
+        if limiter is not None:
+            limiter.acquire()
+
+    def request(self, method, url, **kwargs):
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = self.timeout
+        self.throttle(url)
+        return self.session.request(method, url, **kwargs)
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def close(self):
+        self.session.close()
+
+def iter_sse_data(response):
+    # Yields the data field of every server-sent event in a streamed
+    # response, multi-line data fields are joined with newlines. Lines are
+    # decoded as UTF-8 since event streams often come without a charset.
+    data = []
+    for line in response.iter_lines():
+        line = line.decode('utf-8')
+        if not line:
+            if data:
+                yield '\n'.join(data)
+                data = []
+        elif line.startswith('data:'):
+            data.append(line[5:].lstrip())
+    if data:
+        yield '\n'.join(data)
+
+_default_client = None
+_default_client_lock = threading.Lock()
+
+def configure_http_client(**kwargs):
+    global _default_client
+    with _default_client_lock:
+        if _default_client is not None:
+            _default_client.close()
+        _default_client = HttpClient(**kwargs)
+    return _default_client
+
+def get_http_client():
+    global _default_client
+    if _default_client is None:
+        with _default_client_lock:
+            if _default_client is None:
+                _default_client = HttpClient()
+    return _default_client
@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# File              : json_util.py
+# Author            : Yan <yanwong@126.com>
+# Date              : 17.10.2026
+# Last Modified Date: 17.10.2026
+# Last Modified By  : Yan <yanwong@126.com>
+
+import json
+import logging
+import re
+
+logger = logging.getLogger(__name__)
+
+class ArrayItemStreamParser(object):
+    # Incrementally scans JSON text as it is generated and emits every
+    # element of the array under `key` as soon as its closing bracket
+    # arrives, e.g. each day of {"city": ..., "days": [{...}, {...}]}.
+    # Text around the JSON, like ```json fences, is ignored.
+
+    def __init__(self, key='days'):
+        self.key_pattern = re.compile(r'"' + re.escape(key) + r'"\s*:\s*$')
+        self.buffer = ''
+        self.pos = 0
+        self.in_string = False
+        self.escape = False
+        self.stack = []  # open brackets
+        self.array_depth = None  # len(stack) inside the target array
+        self.item_start = None
+
+    def feed(self, chunk):
+        items = []
+        self.buffer += chunk
+        while self.pos < len(self.buffer):
+            ch = self.buffer[self.pos]
+            if self.in_string:
+                if self.escape:
+                    self.escape = False
+                elif ch == '\\':
+                    self.escape = True
+                elif ch == '"':
+                    self.in_string = False
+            elif ch == '"':
+                self.in_string = True
+            elif ch in '{[':
+                if ch == '[' and self.array_depth is None and \
+                        self.key_pattern.search(self.buffer, 0, self.pos):
+                    self.array_depth = len(self.stack) + 1
+                elif len(self.stack) == self.array_depth:
+                    self.item_start = self.pos
+                self.stack.append(ch)
+            elif ch in '}]':
+                if self.stack:
+                    self.stack.pop()
+                if self.item_start is not None and \
+                        len(self.stack) == self.array_depth:
+                    item = self.buffer[self.item_start:self.pos + 1]
+                    self.item_start = None
+                    try:
+                        items.append(repair_loads(item)[0])
+                    except ValueError as e:
+                        logger.warning('Skip unparsable item: {}'.format(e))
+                elif self.array_depth is not None and \
+                        len(self.stack) < self.array_depth:
+                    self.array_depth = -1  # target array closed
+            self.pos += 1
+        return items
+
+FULLWIDTH_PUNCTUATION = {
+    '，': ',', '：': ':', '｛': '{', '｝': '}', '［': '[', '］': ']',
+    '【': '[', '】': ']'
+}
+# Quotes LLMs sometimes use as string delimiters, mapped to their closers.
+QUOTE_PAIRS = {'"': '"', "'": "'", '“': '”', '‘': '’'}
+
+REPAIR_COMMENT = 'comment'
+REPAIR_TRAILING_COMMA = 'trailing_comma'
+REPAIR_SINGLE_QUOTE = 'single_quote'
+REPAIR_FULLWIDTH = 'fullwidth_punctuation'
+REPAIR_UNCLOSED_STRING = 'unclosed_string'
+REPAIR_UNCLOSED_BRACKET = 'unclosed_bracket'
+REPAIR_TRUNCATED_VALUE = 'truncated_value'
+
+def extract_json_text(text):
+    # Drops ```json fences and any prose before the first opening brace.
+    m = re.search(r'```(?:json)?(.*?)(?:```|$)', text, re.DOTALL)
+    if m and '{' in m.group(1):
+        text = m.group(1)
+    start = text.find('{')
+    if start < 0:
+        start = text.find('｛')
+    return text[start:] if start >= 0 else text
+
+def _drop_trailing_comma(out):
+    i = len(out) - 1
+    while i >= 0 and out[i] in ' \t\r\n':
+        i -= 1
+    if i >= 0 and out[i] == ',':
+        del out[i]
+        return True
+    return False
+
+def repair_json_text(text):
+    # Rewrites almost-JSON into JSON and returns it with the names of the
+    # repairs applied. Content inside strings is left untouched.
+    repairs = []
+    out, stack = [], []
+    closer = None  # closing quote of the current string
+    last_close = None  # (len(out), stack) after the last closed bracket
+    i, n = 0, len(text)
+
+    def _repair(name):
+        if name not in repairs:
+            repairs.append(name)
+
+    while i < n:
+        ch = text[i]
+        if closer:
+            if ch == '\\' and i + 1 < n:
+                # \' is only valid in single quoted strings, not in JSON.
+                out.append("'" if text[i + 1] == "'" else text[i:i + 2])
+                i += 2
+                continue
+            if ch == closer:
+                out.append('"')
+                closer = None
+            elif ch == '"':
+                out.append('\\"')  # inside a single or curly quoted string
+            else:
+                out.append(ch)
+            i += 1
+            continue
+
+        if ch in QUOTE_PAIRS:
+            if ch == "'":
+                _repair(REPAIR_SINGLE_QUOTE)
+            elif ch != '"':
+                _repair(REPAIR_FULLWIDTH)
+            closer = QUOTE_PAIRS[ch]
+            out.append('"')
+        elif ch == '/' and text.startswith('//', i):
+            end = text.find('\n', i)
+            i = n if end < 0 else end
+            _repair(REPAIR_COMMENT)
+            continue
+        elif ch == '/' and text.startswith('/*', i):
+            end = text.find('*/', i + 2)
+            i = n if end < 0 else end + 2
+            _repair(REPAIR_COMMENT)
+            continue
+        else:
+            if ch in FULLWIDTH_PUNCTUATION:
+                ch = FULLWIDTH_PUNCTUATION[ch]
+                _repair(REPAIR_FULLWIDTH)
+            if ch in '{[':
+                stack.append(ch)
+            elif ch in '}]':
+                if _drop_trailing_comma(out):
+                    _repair(REPAIR_TRAILING_COMMA)
+                if stack:
+                    stack.pop()
+                out.append(ch)
+                last_close = (len(out), list(stack))
+                if not stack:
+                    break  # ignore whatever follows the top-level object
+                i += 1
+                continue
+            out.append(ch)
+        i += 1
+
+    if closer or stack:
+        # Truncated output. Cut back to the last complete object or array
+        # rather than keeping a half written entry, then close the rest.
+        if last_close and (closer or out[last_close[0]:] and
+                           ''.join(out[last_close[0]:]).strip(' \t\r\n,')):
+            del out[last_close[0]:]
+            stack = last_close[1]
+            _repair(REPAIR_TRUNCATED_VALUE)
+        elif closer:
+            out.append('"')
+            _repair(REPAIR_UNCLOSED_STRING)
+        text = ''.join(out).rstrip()
+        while text and text[-1] in ',:':
+            text = text[:-1].rstrip()
+        if stack:
+            _repair(REPAIR_UNCLOSED_BRACKET)
+        closers = {'{': '}', '[': ']'}
+        return text + ''.join(closers[b] for b in reversed(stack)), repairs
+
+    return ''.join(out), repairs
+
+def repair_loads(text):
+    # Parses JSON generated by an LLM, returning (obj, repairs). Raises
+    # ValueError if the text can not be repaired.
+    text = extract_json_text(text)
+    try:
+        return json.loads(text, strict=False), []
+    except ValueError:
+        pass
+
+    repaired, repairs = repair_json_text(text)
+    return json.loads(repaired, strict=False), repairs
@@ -7,20 +7,140 @@
 # Last Modified By  : Yan <yanwong@126.com>
 
 import os
+from collections import OrderedDict
+import hashlib
 import json
 import logging
 import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
-import requests
-import plotly.graph_objects as go
+import numpy as np
+
+from http_util import get_http_client
+from metrics_util import CacheStats, metrics, timed
+from retry_util import (
+    REASON_AUTH, REASON_INVALID_REQUEST, REASON_QUOTA, REASON_RATE_LIMIT,
+    REASON_SERVER, REASON_UNKNOWN, classify_exception
+)
 
 logger = logging.getLogger(__name__)
 
+GEOCODE_BATCH_SIZE = 10  # limit of Gaode geocode api in batch mode
+
+class Point(object):
+    # A location as Gaode gives it, 'lon,lat', parsed once.
+    __slots__ = ('lon', 'lat')
+
+    def __init__(self, lon, lat):
+        self.lon = lon
+        self.lat = lat
+
+    @staticmethod
+    def parse(text):
+        lon, lat = text.split(',')
+        return Point(float(lon), float(lat))
+
+    @staticmethod
+    def of(location):
+        return location if isinstance(location, Point) else Point.parse(location)
+
+    def __iter__(self):
+        return iter((self.lon, self.lat))
+
+    def __eq__(self, other):
+        return isinstance(other, Point) and \
+            (self.lon, self.lat) == (other.lon, other.lat)
+
+    def __hash__(self):
+        return hash((self.lon, self.lat))
+
+    def __str__(self):
+        return '{:.6f},{:.6f}'.format(self.lon, self.lat)
+
+    def __repr__(self):
+        return 'Point({}, {})'.format(self.lon, self.lat)
+
+class PointArray(object):
+    # Locations stored as a (n, 2) float array of lon, lat columns. Indexing
+    # gives a Point, slicing another PointArray.
+
+    def __init__(self, coords=None):
+        if coords is None:
+            coords = np.empty((0, 2))
+        self.coords = np.asarray(coords, dtype=float).reshape(-1, 2)
+
+    @staticmethod
+    def of(locations):
+        # Points, 'lon,lat' strings or a PointArray.
+        if isinstance(locations, PointArray):
+            return locations
+        return PointArray([tuple(Point.of(loc)) for loc in locations])
+
+    @staticmethod
+    def concat(arrays):
+        arrays = [a.coords for a in arrays]
+        return PointArray(np.concatenate(arrays) if arrays else None)
+
+    @property
+    def lons(self):
+        return self.coords[:, 0]
+
+    @property
+    def lats(self):
+        return self.coords[:, 1]
+
+    def __len__(self):
+        return len(self.coords)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return PointArray(self.coords[i])
+        lon, lat = self.coords[i]
+        return Point(float(lon), float(lat))
+
+    def __iter__(self):
+        return (Point(float(lon), float(lat)) for lon, lat in self.coords)
+
+    def __repr__(self):
+        return 'PointArray({})'.format(self.to_strings())
+
+    def to_strings(self):
+        return ['{:.6f},{:.6f}'.format(lon, lat) for lon, lat in self.coords]
+
+    def center(self):
+        lon, lat = self.coords.mean(axis=0)
+        return float(lon), float(lat)
+
+    def bbox(self):
+        # (min_lon, min_lat, max_lon, max_lat)
+        (min_lon, min_lat), (max_lon, max_lat) = \
+            self.coords.min(axis=0), self.coords.max(axis=0)
+        return float(min_lon), float(min_lat), float(max_lon), float(max_lat)
+
 def locations_center(locations):
-    lon_lat = [loc.split(',') for loc in locations]
-    center_lon = sum([float(ll[0]) for ll in lon_lat]) / len(lon_lat)
-    center_lat = sum([float(ll[1]) for ll in lon_lat]) / len(lon_lat)
-    return center_lon, center_lat
+    return PointArray.of(locations).center()
+
+def _mercator_y(lat):
+    lat = np.radians(np.clip(lat, -85, 85))
+    return np.log(np.tan(np.pi / 4 + lat / 2))
+
+def bbox_zoom(bbox, width=600, height=450, padding=1.0,
+              min_zoom=3, max_zoom=15, point_zoom=12):
+    # Largest web mercator zoom level showing the whole bbox in a map of
+    # width * height pixels, less padding levels for the markers.
+    min_lon, min_lat, max_lon, max_lat = bbox
+    lon_span = max_lon - min_lon
+    y_span = _mercator_y(max_lat) - _mercator_y(min_lat)
+    if lon_span <= 0 and y_span <= 0:
+        return point_zoom
+
+    zooms = []
+    if lon_span > 0:
+        zooms.append(np.log2(width * 360 / (256 * lon_span)))
+    if y_span > 0:
+        zooms.append(np.log2(height * 2 * np.pi / (256 * y_span)))
+    return float(np.clip(min(zooms) - padding, min_zoom, max_zoom))
 
 def same_province(code1, code2):
     return int(code1) // 1000 == int(code2) // 1000
@@ -28,68 +148,171 @@ def same_province(code1, code2):
 def same_city(code1, code2):
     return int(code1) // 100 == int(code2) // 100
 
-def plot_markers_map(location_traces, marker_size=10):
-    fig = go.Figure()
+_map_template = None
 
-    locations = []
+def map_template():
+    # Layout and trace defaults shared by every map, so each figure only
+    # carries its own markers and center. plotly is imported on the first
+    # map, not at start.
+    global _map_template
+    if _map_template is None:
+        import plotly.graph_objects as go
+        _map_template = go.layout.Template(
+            layout=go.Layout(
+                mapbox_style='open-street-map',
+                hovermode='closest',
+                mapbox=dict(bearing=0, pitch=0)
+            ),
+            data={'scattermapbox': [go.Scattermapbox(
+                mode='markers',
+                hoverinfo='text',
+                hovertemplate='<b>%{customdata}</b>'
+            )]}
+        )
+    return _map_template
+
+def plot_markers_map(location_traces, marker_size=10):
+    import plotly.graph_objects as go
+    data = []
+    arrays = []
     for tr in location_traces:
-        locations.extend(tr['locations'])
-        lon_lat = [loc.split(',') for loc in tr['locations']]
+        points = PointArray.of(tr['locations'])
+        arrays.append(points)
 
-        fig.add_trace(go.Scattermapbox(
+        data.append(go.Scattermapbox(
             name=tr['trace'],
             customdata=tr['addresses'],
-            lat=[ll[1] for ll in lon_lat],
-            lon=[ll[0] for ll in lon_lat],
-            mode='markers',
-            marker=go.scattermapbox.Marker(
-                size=marker_size
-            ),
-            hoverinfo='text',
-            hovertemplate='<b>%{customdata}</b>'
+            lat=points.lats,
+            lon=points.lons,
+            marker=dict(size=marker_size)
         ))
 
-    if not locations:
+    fig = go.Figure(data=data, layout=dict(template=map_template()))
+    points = PointArray.concat(arrays)
+    if not len(points):
         logger.warning('No marker locations provided, can not plot.')
         return fig
 
-    center_lon, center_lat = locations_center(locations)
-
-    fig.update_layout(
-        mapbox_style="open-street-map",
-        hovermode='closest',
-        mapbox=dict(
-            bearing=0,
-            center=go.layout.mapbox.Center(
-                lat=center_lat,
-                lon=center_lon
-            ),
-            pitch=0,
-            zoom=9
-        )
-    )
+    center_lon, center_lat = points.center()
+    fig.update_layout(mapbox=dict(
+        center=dict(lat=center_lat, lon=center_lon),
+        zoom=bbox_zoom(points.bbox())))
     return fig
 
+class SerializedFigure(object):
+    # A plotly figure already serialized to JSON. gr.Plot only calls
+    # to_json() on the figures it shows, so this can be returned in place
+    # of the figure and is never serialized again. This relies on
+    # gr.Plot.postprocess of gradio 4.19, pinned in requirements.txt and
+    # checked by tests/test_map_util.py.
+
+    def __init__(self, fig):
+        self.json = fig.to_json()
+
+    def to_json(self):
+        return self.json
+
+class MapFigureCache(CacheStats):
+    # Serialized maps keyed by the fingerprint of their markers. The same
+    # cities and plans are drawn again and again, e.g. the default map on
+    # every page load or a cached advise, and are then sent as is.
+
+    def __init__(self, max_entries=256, marker_size=10):
+        self.max_entries = max_entries
+        self.marker_size = marker_size
+        self.figures = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def fingerprint(location_traces):
+        markers = [
+            [tr['trace'], tr['locations'], tr['addresses']]
+            for tr in location_traces
+        ]
+        return hashlib.sha1(json.dumps(
+            markers, ensure_ascii=False, default=str).encode('utf-8')).hexdigest()
+
+    def plot(self, location_traces):
+        key = self.fingerprint(location_traces)
+        with self._lock:
+            fig = self.figures.get(key)
+            if fig is not None:
+                self.figures.move_to_end(key)
+                self.hits += 1
+                return fig
+            self.misses += 1
+
+        fig = SerializedFigure(
+            plot_markers_map(location_traces, self.marker_size))
+        with self._lock:
+            self.figures[key] = fig
+            while len(self.figures) > self.max_entries:
+                self.figures.popitem(last=False)
+        return fig
+
+# Keywords of the info of failed Gaode calls, e.g. CUQPS_HAS_EXCEEDED_THE_LIMIT
+# or INVALID_USER_KEY, checked in order.
+# https://lbs.amap.com/api/webservice/guide/tools/info
+GAODE_INFO_REASONS = [
+    (('QPS', 'TOO_FREQUENT'), REASON_RATE_LIMIT),
+    (('OVER_LIMIT', 'QUOTA'), REASON_QUOTA),
+    (('KEY', 'SIGNATURE', 'USER_IP', 'SCODE', 'PRIVILEGES', 'SERVICE_NOT_AVAILABLE',
+      'SERVICE_EXPIRED'), REASON_AUTH),
+    (('PARAM', 'ILLEGAL_REQUEST', 'OVER_DIRECTION_RANGE'), REASON_INVALID_REQUEST),
+    (('ENGINE', 'SERVER', 'UNAVAILABLE'), REASON_SERVER),
+]
+
+def classify_gaode_info(info):
+    # The info is free text, only its reason makes a metric label.
+    info = str(info).upper()
+    for keywords, reason in GAODE_INFO_REASONS:
+        if any(k in info for k in keywords):
+            return reason
+    return REASON_UNKNOWN
+
 class GaodeGeo(object):
     def __init__(self, geocode_url, poi_url, staticmap_url,
-                 staticmap_scale='2', staticmap_size='400*400'):
+                 staticmap_scale='2', staticmap_size='400*400',
+                 city_index=None, location_cache=None, http_client=None,
+                 max_workers=4, gazetteer=None):
         self.api_key = os.environ['GAODE_API_KEY']
+        self.http = http_client or get_http_client()
         self.geocode_url = geocode_url
         self.poi_url = poi_url
         self.staticmap_url = staticmap_url
         self.staticmap_scale = staticmap_scale  # 1: general 2: hd
         self.staticmap_size = staticmap_size  # largest: 1024*1024
+        self.city_index = city_index
+        self.location_cache = location_cache  # e.g. a SqliteCache
+        self.gazetteer = gazetteer  # attractions known offline
+        self.executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix='gaode-geo')
+
+    def _same_province(self, code1, code2):
+        if self.city_index:
+            return self.city_index.same_province(code1, code2)
+        return same_province(code1, code2)
 
+    def _same_city(self, code1, code2):
+        if self.city_index:
+            return self.city_index.same_city(code1, code2)
+        return same_city(code1, code2)
+
+    @timed('gaode_geocode')
     def get_geocode(self, address, city=None):
         payload = {'address': address, 'key': self.api_key}
         if city:
             payload['city'] = city
         geocode = []
         try:
-            res = requests.get(self.geocode_url, params=payload)
+            res = self.http.get(self.geocode_url, params=payload)
             res_content = json.loads(res.text)
             if res_content['status'] == 0:
                 logger.error('Gaode geocode api error: {}'.format(res_content['info']))
+                metrics.count_error(
+                    'gaode_geocode', classify_gaode_info(res_content['info']))
                 return geocode
 
             geocode = [{
@@ -102,73 +325,228 @@ class GaodeGeo(object):
 
         except Exception as e:
             logger.error('Get geocode failed: {}'.format(e))
+            metrics.count_error('gaode_geocode', classify_exception(e))
 
         return geocode
 
+    def _get_cached_location(self, address, city):
+        # Attractions of the gazetteer are resolved without any request.
+        if self.gazetteer is not None and city:
+            location = self.gazetteer.lookup(address, city)
+            if location:
+                return PointArray.of([location])
+        if self.location_cache is None:
+            return None
+        location = self.location_cache.get(
+            self.location_cache.make_key(address, city or ''))
+        return PointArray.of(location) if location else None
+
+    def _cache_location(self, address, city, location):
+        # Only cache successful lookups so that transient failures are
+        # retried next time.
+        if location and self.location_cache is not None:
+            self.location_cache.set(
+                self.location_cache.make_key(address, city or ''),
+                location.to_strings())
+
     def get_location(self, address, city=None):
-        payload = {'address': address, 'key': self.api_key}
+        location = self._get_cached_location(address, city)
+        if location:
+            return location
+
+        location = self._request_location(address, city)
+        self._cache_location(address, city, location)
+        return location
+
+    def get_locations(self, addresses, city=None):
+        # Geocodes many addresses with Gaode's batch mode, which takes up to
+        # GEOCODE_BATCH_SIZE addresses per request. Chunks are requested
+        # concurrently and the result is aligned with addresses.
+        found = {}
+        for addr in addresses:
+            if addr not in found:
+                found[addr] = self._get_cached_location(addr, city)
+        missing = [addr for addr, loc in found.items() if not loc]
+
+        chunks = [
+            missing[i:i + GEOCODE_BATCH_SIZE]
+            for i in range(0, len(missing), GEOCODE_BATCH_SIZE)
+        ]
+        futures = [
+            self.executor.submit(self._request_locations_batch, chunk, city)
+            for chunk in chunks
+        ]
+        for chunk, future in zip(chunks, futures):
+            found.update(zip(chunk, future.result()))
+
+        # Fall back to POI search one by one, just like get_location.
+        no_geocode = [addr for addr in missing if not found[addr]]
+        futures = [
+            self.executor.submit(self._search_poi, addr, city)
+            for addr in no_geocode
+        ]
+        for addr, future in zip(no_geocode, futures):
+            found[addr] = future.result()
+
+        for addr in missing:
+            self._cache_location(addr, city, found[addr])
+        return [found[addr] or PointArray() for addr in addresses]
+
+    def _filter_locations(self, geocodes, city=None):
+        location = []
+        for g in geocodes:
+            lon_lat = g.get('location')
+            # Unmatched addresses of a batch request come with empty fields.
+            if not lon_lat or not isinstance(lon_lat, str):
+                continue
+
+            if not city:
+                location.append(lon_lat)
+            elif re.match(r'(110|120|310|500)\d{3}', city) and \
+                    self._same_province(city, g['adcode']):
+                location.append(lon_lat)
+            elif re.match(r'\d{6}', city) and \
+                    self._same_city(city, g['adcode']):
+                location.append(lon_lat)
+            elif re.match(r'\d{3,4}', city) and city == g['citycode']:
+                location.append(lon_lat)
+            elif city in g['formatted_address']:
+                location.append(lon_lat)
+        return PointArray.of(location)
+
+    @timed('gaode_geocode_batch')
+    def _request_locations_batch(self, addresses, city=None):
+        # '|' separates addresses in batch mode.
+        payload = {
+            'address': '|'.join(addr.replace('|', ' ') for addr in addresses),
+            'batch': 'true', 'key': self.api_key
+        }
         if city:
             payload['city'] = city
-        location = []
+        locations = [PointArray() for _ in addresses]
         try:
-            res = requests.get(self.geocode_url, params=payload)
+            res = self.http.get(self.geocode_url, params=payload)
             res_content = json.loads(res.text)
 
             if res_content['status'] == 0:
                 logger.error('Gaode geocode api error: {}'.format(res_content['info']))
+                metrics.count_error(
+                    'gaode_geocode_batch', classify_gaode_info(res_content['info']))
+                return locations
+
+            geocodes = res_content.get('geocodes') or []
+            for i, g in enumerate(geocodes[:len(addresses)]):
+                locations[i] = self._filter_locations([g], city)
+        except Exception as e:
+            logger.error('Get locations in batch failed: {}'.format(e))
+            metrics.count_error('gaode_geocode_batch', classify_exception(e))
+
+        return locations
+
+    @timed('gaode_poi')
+    def _search_poi(self, address, city=None):
+        logger.warning(f'Searching POI of {address}:{city}')
+        payload = {'keywords': address, 'citylimit': True, 'key': self.api_key}
+        if city:
+            payload['city'] = city
+        location = PointArray()
+        try:
+            res = self.http.get(self.poi_url, params=payload)
+            res_content = json.loads(res.text)
+
+            if res_content['status'] == 0:
+                logger.error('Gaode poi api error: {}'.format(res_content['info']))
+                metrics.count_error(
+                    'gaode_poi', classify_gaode_info(res_content['info']))
                 return location
 
-            geocodes = res_content.get('geocodes')
-            if geocodes:
-                if not city:
-                    location = [g['location'] for g in res_content['geocodes']]
-                else:
-                    for g in geocodes:
-                        lon_lat = g['location']
-
-                        if re.match(r'(110|120|310|500)\d{3}', city) and \
-                                same_province(city, g['adcode']):
-                            location.append(lon_lat)
-                        elif re.match(r'\d{6}', city) and same_city(city, g['adcode']):
-                            location.append(lon_lat)
-                        elif re.match(r'\d{3,4}', city) and city == g['citycode']:
-                            location.append(lon_lat)
-                        elif city in g['formatted_address']:
-                            location.append(lon_lat)
+            pois = res_content.get('pois')
+            if pois:
+                location = PointArray.of(
+                    [p['location'] for p in pois if p.get('location')])
             else:
                 logger.warning(
-                    f'Gaode does not provide geocodes of {address}:{city}'
+                    f'Gaode does not provide poi of {address}:{city}'
                 )
+        except Exception as e:
+            logger.error('Search POI failed: {}'.format(e))
+            metrics.count_error('gaode_poi', classify_exception(e))
 
-            if not location:
-                logger.warning(f'Searching POI of {address}:{city}')
+        return location
 
-                payload.update({'keywords': address, 'citylimit': True})
-                res = requests.get(self.poi_url, params=payload)
-                res_content = json.loads(res.text)
+    def get_nearby_attractions(self, location, city, radius_km=5, limit=10):
+        # Answered by the gazetteer alone, no api call.
+        if self.gazetteer is None or not location:
+            return []
+        point = Point.of(location)
+        return self.gazetteer.nearby(city, point.lon, point.lat, radius_km, limit)
 
-                if res_content['status'] == 0:
-                    logger.error('Gaode poi api error: {}'.format(res_content['info']))
-                    return location
+    @timed('gaode_poi')
+    def search_attractions(self, city, page=1, page_size=25, types='110000'):
+        # POIs of type 风景名胜 (110000) in the city, used to build the
+        # offline gazetteer.
+        payload = {
+            'types': types, 'city': city, 'citylimit': True,
+            'offset': page_size, 'page': page, 'key': self.api_key
+        }
+        attractions = []
+        try:
+            res = self.http.get(self.poi_url, params=payload)
+            res_content = json.loads(res.text)
 
-                pois = res_content.get('pois')
-                if pois:
-                    location = [p['location'] for p in pois]
-                else:
-                    logger.warning(
-                        f'Gaode does not provide poi of {address}:{city}'
-                    )
+            if res_content['status'] == 0:
+                logger.error('Gaode poi api error: {}'.format(res_content['info']))
+                metrics.count_error(
+                    'gaode_poi', classify_gaode_info(res_content['info']))
+                return attractions
+
+            attractions = [
+                {'name': p['name'], 'location': p['location']}
+                for p in res_content.get('pois') or [] if p.get('location')
+            ]
+        except Exception as e:
+            logger.error('Search attractions failed: {}'.format(e))
+            metrics.count_error('gaode_poi', classify_exception(e))
+
+        return attractions
+
+    @timed('gaode_geocode')
+    def _request_location(self, address, city=None):
+        payload = {'address': address, 'key': self.api_key}
+        if city:
+            payload['city'] = city
+        location = PointArray()
+        try:
+            res = self.http.get(self.geocode_url, params=payload)
+            res_content = json.loads(res.text)
+
+            if res_content['status'] == 0:
+                logger.error('Gaode geocode api error: {}'.format(res_content['info']))
+                metrics.count_error(
+                    'gaode_geocode', classify_gaode_info(res_content['info']))
+                return location
+
+            geocodes = res_content.get('geocodes')
+            if geocodes:
+                location = self._filter_locations(geocodes, city)
+            else:
+                logger.warning(
+                    f'Gaode does not provide geocodes of {address}:{city}'
+                )
         except Exception as e:
             logger.error('Get location failed: {}'.format(e))
+            metrics.count_error('gaode_geocode', classify_exception(e))
 
+        if not location:
+            location = self._search_poi(address, city)
         return location
 
+    @timed('gaode_staticmap')
     def get_staticmap(self, addresses, city, locations=None, marker=False, label=True):
         if not locations:
-            locations = []
-            for addr in addresses:
-                coords = self.get_location(addr, city)
-                locations.append(coords[0])
+            locations = [
+                coords[0] for coords in self.get_locations(addresses, city)
+            ]
 
         payload = {'size': self.staticmap_size, 'scale': self.staticmap_scale,
                    'key': self.api_key}
@@ -176,19 +554,20 @@ class GaodeGeo(object):
             markers = []
             for addr, loc in zip(addresses, locations):
                 marker_style = ','.join(['mid', '0xFF0000', addr[0]])
-                markers.append(marker_style + ':' + loc)
+                markers.append(marker_style + ':' + str(loc))
             payload['markers'] = '|'.join(markers)
         if label:
             labels = []
             for addr, loc in zip(addresses, locations):
                 label_style = ','.join([addr, '0', '1', '20', '0x000000', '0xFF0000'])
-                labels.append(label_style + ':' + loc)
+                labels.append(label_style + ':' + str(loc))
             payload['labels'] = '|'.join(labels)
 
         try:
-            res = requests.get(self.staticmap_url, params=payload)
+            res = self.http.get(self.staticmap_url, params=payload)
         except Exception as e:
             logger.error('Get staticmap failed: {}'.format(e))
+            metrics.count_error('gaode_staticmap', classify_exception(e))
             return ''
         return res.content
 
@@ -0,0 +1,275 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# File              : metrics_util.py
+# Author            : Yan <yanwong@126.com>
+# Date              : 17.10.2026
+# Last Modified Date: 17.10.2026
+# Last Modified By  : Yan <yanwong@126.com>
+
+import bisect
+import functools
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import inspect
+import logging
+import threading
+import time
+
+from retry_util import classify_exception
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds in seconds, from a cached lookup to a long generation.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10,
+                   20, 40, 80, 160)
+
+def _format_labels(labelnames, values, extra=()):
+    pairs = list(zip(labelnames, values)) + list(extra)
+    if not pairs:
+        return ''
+    escaped = [
+        '{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"')
+                         .replace('\n', '\\n'))
+        for k, v in pairs
+    ]
+    return '{' + ','.join(escaped) + '}'
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+class Counter(object):
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} counter']
+        with self._lock:
+            values = sorted(self._values.items())
+        for labels, value in values:
+            lines.append('{}{} {}'.format(
+                self.name, _format_labels(self.labelnames, labels),
+                _format_value(value)))
+        return lines
+
+class Histogram(object):
+    def __init__(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._values = {}  # labels -> [bucket counts, sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(labels)
+            if entry is None:
+                entry = self._values[labels] = [[0] * len(self.buckets), 0.0, 0]
+            if i < len(self.buckets):
+                entry[0][i] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}',
+                 f'# TYPE {self.name} histogram']
+        with self._lock:
+            values = sorted(
+                (labels, (list(e[0]), e[1], e[2]))
+                for labels, e in self._values.items())
+        for labels, (counts, total, count) in values:
+            cumulative = 0
+            for bound, n in zip(self.buckets, counts):
+                cumulative += n
+                lines.append('{}_bucket{} {}'.format(
+                    self.name,
+                    _format_labels(self.labelnames, labels, [('le', bound)]),
+                    cumulative))
+            lines.append('{}_bucket{} {}'.format(
+                self.name,
+                _format_labels(self.labelnames, labels, [('le', '+Inf')]),
+                count))
+            label_str = _format_labels(self.labelnames, labels)
+            lines.append(f'{self.name}_sum{label_str} {_format_value(total)}')
+            lines.append(f'{self.name}_count{label_str} {count}')
+        return lines
+
+class Gauge(object):
+    # Read when rendered from fn, which returns {labels tuple: value}.
+
+    def __init__(self, name, help, labelnames, fn):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.fn = fn
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} gauge']
+        try:
+            values = sorted(self.fn().items())
+        except Exception as e:
+            logger.error('Collect gauge {} failed: {}'.format(self.name, e))
+            values = []
+        for labels, value in values:
+            lines.append('{}{} {}'.format(
+                self.name, _format_labels(self.labelnames, labels),
+                _format_value(value)))
+        return lines
+
+def hit_stats(hits, misses):
+    total = hits + misses
+    return {
+        'hits': hits, 'misses': misses,
+        'hit_ratio': hits / total if total else 0.0
+    }
+
+class CacheStats(object):
+    # Mixin for caches counting their lookups in hits and misses.
+    hits = 0
+    misses = 0
+
+    def stats(self):
+        return hit_stats(self.hits, self.misses)
+
+class MetricsRegistry(object):
+    def __init__(self, prefix='wego'):
+        self.prefix = prefix
+        self._metrics = []
+        self._lock = threading.Lock()
+
+        self.stage_seconds = self.histogram(
+            'stage_duration_seconds',
+            'Latency of pipeline steps and external calls.', ['stage'])
+        self.stage_errors = self.counter(
+            'stage_errors_total', 'Failures of pipeline steps and external calls.',
+            ['stage', 'reason'])
+        self.llm_tokens = self.counter(
+            'llm_tokens_total', 'Tokens used by the LLM backends.',
+            ['backend', 'kind'])
+        self._caches = {}
+        self.gauge('cache_hits', 'Cache hits.', ['cache'],
+                   lambda: self._cache_stats('hits'))
+        self.gauge('cache_misses', 'Cache misses.', ['cache'],
+                   lambda: self._cache_stats('misses'))
+        self.gauge('cache_hit_ratio', 'Share of lookups served by the cache.',
+                   ['cache'], lambda: self._cache_stats('hit_ratio'))
+
+    def _register(self, metric):
+        with self._lock:
+            self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, labelnames=()):
+        return self._register(Counter(f'{self.prefix}_{name}', help, labelnames))
+
+    def histogram(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        return self._register(
+            Histogram(f'{self.prefix}_{name}', help, labelnames, buckets))
+
+    def gauge(self, name, help, labelnames, fn):
+        return self._register(Gauge(f'{self.prefix}_{name}', help, labelnames, fn))
+
+    def register_cache(self, name, cache):
+        # cache counts its hits and misses, see CacheStats.
+        self._caches[name] = cache
+
+    def _cache_stats(self, key):
+        return {(name, ): hit_stats(cache.hits, cache.misses)[key]
+                for name, cache in self._caches.items()}
+
+    def observe(self, stage, seconds):
+        self.stage_seconds.observe(seconds, stage)
+
+    def count_error(self, stage, reason):
+        self.stage_errors.inc(stage, reason)
+
+    def count_tokens(self, backend, input_tokens=0, output_tokens=0):
+        if input_tokens:
+            self.llm_tokens.inc(backend, 'input', amount=input_tokens)
+        if output_tokens:
+            self.llm_tokens.inc(backend, 'output', amount=output_tokens)
+
+    def render(self):
+        with self._lock:
+            metrics = list(self._metrics)
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+metrics = MetricsRegistry()
+
+def _record_result(stage, result):
+    # A GenerationFailure, or any result carrying a reason, is a failure.
+    reason = getattr(result, 'reason', None)
+    if reason and not result:
+        metrics.count_error(stage, reason)
+
+def timed(stage):
+    # Records the latency of every call to the decorated function, and
+    # failures: raised exceptions and results with a reason. Generators are
+    # timed until exhausted.
+    def decorator(fn):
+        if inspect.isgeneratorfunction(fn):
+            @functools.wraps(fn)
+            def gen_wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    yield from fn(*args, **kwargs)
+                except Exception as e:
+                    metrics.count_error(stage, classify_exception(e))
+                    raise
+                finally:
+                    metrics.observe(stage, time.perf_counter() - start)
+            return gen_wrapper
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                result = fn(*args, **kwargs)
+            except Exception as e:
+                metrics.count_error(stage, classify_exception(e))
+                raise
+            finally:
+                metrics.observe(stage, time.perf_counter() - start)
+            _record_result(stage, result)
+            return result
+        return wrapper
+    return decorator
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = self.server.registry.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+def start_metrics_server(port, host='0.0.0.0', registry=None):
+    # Serves the metrics at http://host:port/metrics in a daemon thread.
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    server.registry = registry or metrics
+    threading.Thread(target=server.serve_forever, name='metrics-server',
+                     daemon=True).start()
+    logger.info('Serving metrics on http://{}:{}/metrics'.format(
+        host, server.server_address[1]))
+    return server
@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# File              : retry_util.py
+# Author            : Yan <yanwong@126.com>
+# Date              : 17.10.2026
+# Last Modified Date: 17.10.2026
+# Last Modified By  : Yan <yanwong@126.com>
+
+import logging
+import random
+import threading
+import time
+
+import requests
+
+logger = logging.getLogger(__name__)
+
+# Why a call to an external service failed.
+REASON_RATE_LIMIT = 'rate_limit'
+REASON_QUOTA = 'quota'
+REASON_AUTH = 'auth'
+REASON_TOKEN_EXPIRED = 'token_expired'
+REASON_TIMEOUT = 'timeout'
+REASON_NETWORK = 'network'
+REASON_SERVER = 'server'
+REASON_INVALID_REQUEST = 'invalid_request'
+REASON_PARSE = 'parse'
+REASON_CIRCUIT_OPEN = 'circuit_open'
+REASON_UNKNOWN = 'unknown'
+
+# Failures worth another try, the others will fail again the same way.
+RETRYABLE_REASONS = {
+    REASON_RATE_LIMIT, REASON_TOKEN_EXPIRED, REASON_TIMEOUT, REASON_NETWORK,
+    REASON_SERVER, REASON_PARSE, REASON_UNKNOWN
+}
+# Failures telling that the provider itself is unhealthy. A bad output
+# (parse) or a bad request says nothing about the provider.
+PROVIDER_FAILURE_REASONS = {
+    REASON_RATE_LIMIT, REASON_QUOTA, REASON_AUTH, REASON_TIMEOUT,
+    REASON_NETWORK, REASON_SERVER
+}
+
+def classify_status(status_code):
+    if status_code == 429:
+        return REASON_RATE_LIMIT
+    if status_code in (401, 403):
+        return REASON_AUTH
+    if status_code in (408, 504):
+        return REASON_TIMEOUT
+    if 400 <= status_code < 500:
+        return REASON_INVALID_REQUEST
+    if status_code >= 500:
+        return REASON_SERVER
+    return REASON_UNKNOWN
+
+def classify_exception(e):
+    reason = getattr(e, 'reason', None)
+    if isinstance(reason, str):
+        return reason
+    if isinstance(e, requests.Timeout):
+        return REASON_TIMEOUT
+    if isinstance(e, requests.ConnectionError):
+        return REASON_NETWORK
+    if isinstance(e, ValueError):  # including json.JSONDecodeError
+        return REASON_PARSE
+    return REASON_UNKNOWN
+
+class CircuitBreaker(object):
+    # Opens after failure_threshold consecutive provider failures, so that
+    # requests fail fast instead of waiting for timeouts. After
+    # reset_timeout seconds one trial request is let through (half open),
+    # its outcome closes or reopens the circuit.
+
+    CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half_open'
+
+    def __init__(self, name, failure_threshold=5, reset_timeout=30):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = CircuitBreaker.CLOSED
+        self.failures = 0
+        self.opened_at = 0
+        self._lock = threading.Lock()
+
+    def expired(self):
+        # An open circuit whose reset_timeout has passed.
+        return self.state == CircuitBreaker.OPEN and \
+            time.monotonic() - self.opened_at >= self.reset_timeout
+
+    def ready(self):
+        # Whether allow() may let a request through, without taking the
+        # trial of an expired circuit.
+        return self.state == CircuitBreaker.CLOSED or self.expired()
+
+    def permit(self):
+        # Returns the state the request is let through in, CLOSED or
+        # HALF_OPEN for the single trial, or None when it is not.
+        with self._lock:
+            if self.state == CircuitBreaker.CLOSED:
+                return CircuitBreaker.CLOSED
+            if self.expired():
+                self.state = CircuitBreaker.HALF_OPEN
+                logger.info(f'Circuit of {self.name} is half open.')
+                return CircuitBreaker.HALF_OPEN
+            return None
+
+    def allow(self):
+        return self.permit() is not None
+
+    def release(self, permit):
+        # Gives back a permit whose request ended without an outcome, e.g.
+        # it was cancelled. A trial goes back to the expired open circuit,
+        # so the next request takes it.
+        with self._lock:
+            if permit == CircuitBreaker.HALF_OPEN and \
+                    self.state == CircuitBreaker.HALF_OPEN:
+                self.state = CircuitBreaker.OPEN
+
+    def record_success(self):
+        with self._lock:
+            if self.state != CircuitBreaker.CLOSED:
+                logger.info(f'Circuit of {self.name} is closed.')
+            self.state = CircuitBreaker.CLOSED
+            self.failures = 0
+
+    def record_failure(self, reason=REASON_UNKNOWN):
+        if reason not in PROVIDER_FAILURE_REASONS:
+            # Says nothing about the provider, neither does the trial.
+            self.release(CircuitBreaker.HALF_OPEN)
+            return
+        with self._lock:
+            self.failures += 1
+            if self.state == CircuitBreaker.HALF_OPEN or \
+                    self.failures >= self.failure_threshold:
+                if self.state != CircuitBreaker.OPEN:
+                    logger.warning(
+                        f'Circuit of {self.name} is open after '
+                        f'{self.failures} failures, last: {reason}.')
+                self.state = CircuitBreaker.OPEN
+                self.opened_at = time.monotonic()
+
+class RetryPolicy(object):
+    # Retries a call returning a falsy result on failure. The failure reason
+    # is read from the result's `reason` attribute. Delays grow
+    # exponentially with full jitter, rate limits wait twice as long.
+
+    def __init__(self, max_retry=3, base_delay=0.5, max_delay=8.0):
+        self.max_retry = max_retry
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def delay(self, attempt, reason=REASON_UNKNOWN):
+        ceiling = min(self.max_delay, self.base_delay * 2 ** attempt)
+        if reason == REASON_RATE_LIMIT:
+            ceiling = min(self.max_delay, ceiling * 2)
+        return random.uniform(0, ceiling)
+
+    def call(self, fn, *args, **kwargs):
+        result = None
+        for attempt in range(self.max_retry):
+            result = fn(*args, **kwargs)
+            if result:
+                return result
+
+            reason = getattr(result, 'reason', REASON_UNKNOWN)
+            if reason not in RETRYABLE_REASONS:
+                logger.warning(f'Do not retry on {reason} failure.')
+                break
+            if attempt + 1 < self.max_retry:
+                delay = self.delay(attempt, reason)
+                logger.warning(
+                    f'Retry for the {attempt + 1}th time in {delay:.2f}s '
+                    f'after {reason} failure...')
+                time.sleep(delay)
+        return result
@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# File              : route_util.py
+# Author            : Yan <yanwong@126.com>
+# Date              : 17.10.2026
+# Last Modified Date: 17.10.2026
+# Last Modified By  : Yan <yanwong@126.com>
+
+import itertools
+import logging
+
+import numpy as np
+
+from gazetteer_util import EARTH_RADIUS_KM
+from map_util import PointArray
+
+logger = logging.getLogger(__name__)
+
+# Stops of these slots are sightseeing and may trade places, the others
+# are tied to their time, e.g. lunch at noon or a night market.
+FLEXIBLE_TIME_SLOTS = ('上午', '下午')
+# Up to this many flexible stops all orders are tried, beyond it pairwise
+# swaps improve the order until no swap helps.
+EXACT_MAX_STOPS = 7
+
+def pairwise_haversine_km(coords):
+    lon, lat = np.radians(coords[:, 0]), np.radians(coords[:, 1])
+    dlon = lon[:, None] - lon[None, :]
+    dlat = lat[:, None] - lat[None, :]
+    a = np.sin(dlat / 2) ** 2 + \
+        np.cos(lat[:, None]) * np.cos(lat[None, :]) * np.sin(dlon / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+
+def path_lengths(dist, orders):
+    # Lengths of the open paths visiting stops in each row of orders.
+    return dist[orders[:, :-1], orders[:, 1:]].sum(axis=1)
+
+class DayRouter(object):
+    # Checks how far apart the stops of each day are and shortens the day's
+    # route by reordering stops of flexible time slots. The time labels stay
+    # where they are, only locations and descriptions move between them.
+
+    def __init__(self, max_spread_km=30, min_saving_km=1.0,
+                 flexible_slots=FLEXIBLE_TIME_SLOTS):
+        self.max_spread_km = max_spread_km
+        self.min_saving_km = min_saving_km
+        self.flexible_slots = set(flexible_slots)
+
+    def _best_order(self, dist, order, flexible):
+        orders = np.array([order])
+        if len(flexible) <= EXACT_MAX_STOPS:
+            perms = np.array(list(itertools.permutations(order[flexible])))
+            orders = np.repeat(orders, len(perms), axis=0)
+            orders[:, flexible] = perms
+            return orders[np.argmin(path_lengths(dist, orders))]
+
+        best = order.copy()
+        best_len = path_lengths(dist, orders)[0]
+        improved = True
+        while improved:
+            improved = False
+            for i, j in itertools.combinations(flexible, 2):
+                cand = best.copy()
+                cand[[i, j]] = cand[[j, i]]
+                cand_len = path_lengths(dist, cand[None, :])[0]
+                if cand_len < best_len - 1e-9:
+                    best, best_len, improved = cand, cand_len, True
+        return best
+
+    def route_day(self, day, locations):
+        # locations are aligned with day['schedule']. Returns the day, a new
+        # dict if stops were reordered, and a report of its route.
+        schedule = day['schedule']
+        located = [i for i, loc in enumerate(locations) if loc]
+        report = {'spread_km': 0.0, 'length_km': 0.0,
+                  'flagged': False, 'reordered': False}
+        if len(located) < 2:
+            return day, report
+
+        dist = pairwise_haversine_km(
+            PointArray.of([locations[i] for i in located]).coords)
+        order = np.arange(len(located))
+        length = path_lengths(dist, order[None, :])[0]
+        report['spread_km'] = float(dist.max())
+        report['length_km'] = float(length)
+        report['flagged'] = bool(report['spread_km'] > self.max_spread_km)
+
+        flexible = np.array([
+            k for k, i in enumerate(located)
+            if schedule[i].get('time') in self.flexible_slots
+        ], dtype=int)
+        if len(flexible) < 2:
+            return day, report
+
+        best = self._best_order(dist, order, flexible)
+        best_length = path_lengths(dist, best[None, :])[0]
+        if length - best_length < self.min_saving_km:
+            return day, report
+
+        new_schedule = list(schedule)
+        for k, i in enumerate(located):
+            src = schedule[located[best[k]]]
+            new_schedule[i] = dict(src, time=schedule[i]['time'])
+        report.update({'length_km': float(best_length), 'reordered': True,
+                       'saving_km': float(length - best_length)})
+        return dict(day, schedule=new_schedule), report
+
+    def route_days(self, days, loclists):
+        # loclists are aligned with the stops of all days, as returned by
+        # GaodeGeo.get_locations.
+        loclists = iter(loclists)
+        routed, reports = [], []
+        for d, day in enumerate(days):
+            locations = [
+                (next(loclists) or [None])[0] for _ in day['schedule']]
+            day, report = self.route_day(day, locations)
+            if report['flagged']:
+                logger.warning('Stops of day {} spread over {:.1f}km.'.format(
+                    d + 1, report['spread_km']))
+            if report['reordered']:
+                logger.info('Reorder stops of day {}, saving {:.1f}km.'.format(
+                    d + 1, report['saving_km']))
+            routed.append(day)
+            reports.append(report)
+        return routed, reports
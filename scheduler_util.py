@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# File              : scheduler_util.py
+# Author            : Yan <yanwong@126.com>
+# Date              : 17.10.2026
+# Last Modified Date: 17.10.2026
+# Last Modified By  : Yan <yanwong@126.com>
+
+from collections import Counter, deque
+from contextlib import contextmanager
+import contextvars
+import functools
+import inspect
+import itertools
+import logging
+import threading
+import time
+
+from metrics_util import metrics
+
+logger = logging.getLogger(__name__)
+
+# The session whose request is being handled, set by the event handlers.
+current_session = contextvars.ContextVar('wego_session', default='anonymous')
+
+STAGE_WAIT_SECONDS = metrics.histogram(
+    'stage_wait_seconds', 'Time spent waiting for a slot of a stage.', ['stage'])
+
+class StageBusy(Exception):
+    def __init__(self, stage, message=''):
+        super().__init__(message or f'Stage {stage} is busy')
+        self.stage = stage
+
+class Stage(object):
+    # At most `limit` calls run at once and at most `max_waiting` wait for
+    # a slot, more are rejected right away. A free slot goes to the waiting
+    # session holding the fewest slots, oldest first, and no session holds
+    # more than `per_session` slots, so one session firing many requests
+    # only delays itself.
+
+    def __init__(self, name, limit, max_waiting=64, per_session=2,
+                 wait_timeout=60):
+        self.name = name
+        self.limit = limit
+        self.max_waiting = max_waiting
+        self.per_session = per_session
+        self.wait_timeout = wait_timeout
+
+        self.active = 0
+        self.active_by_session = Counter()
+        self.waiters = deque()  # (ticket, session)
+        self.rejected = 0
+        self._tickets = itertools.count()
+        self._cond = threading.Condition()
+
+    def _next_ticket(self):
+        best = None
+        for ticket, session in self.waiters:
+            held = self.active_by_session[session]
+            if held >= self.per_session:
+                continue
+            if best is None or held < best[0]:
+                best = (held, ticket)
+        return best[1] if best else None
+
+    def acquire(self, session):
+        start = time.monotonic()
+        with self._cond:
+            if len(self.waiters) >= self.max_waiting:
+                self.rejected += 1
+                metrics.count_error(f'{self.name}_queue', 'queue_full')
+                raise StageBusy(self.name, f'Queue of {self.name} is full')
+
+            ticket = next(self._tickets)
+            self.waiters.append((ticket, session))
+            deadline = start + self.wait_timeout
+            try:
+                while self.active >= self.limit or self._next_ticket() != ticket:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self.rejected += 1
+                        metrics.count_error(f'{self.name}_queue', 'wait_timeout')
+                        raise StageBusy(
+                            self.name, f'Waited too long for {self.name}')
+                    self._cond.wait(remaining)
+            finally:
+                self.waiters.remove((ticket, session))
+                # Someone else may be next now.
+                self._cond.notify_all()
+
+            self.active += 1
+            self.active_by_session[session] += 1
+        wait = time.monotonic() - start
+        STAGE_WAIT_SECONDS.observe(wait, self.name)
+        return wait
+
+    def release(self, session):
+        with self._cond:
+            self.active -= 1
+            self.active_by_session[session] -= 1
+            if self.active_by_session[session] <= 0:
+                del self.active_by_session[session]
+            self._cond.notify_all()
+
+    def stats(self):
+        with self._cond:
+            return {'active': self.active, 'waiting': len(self.waiters),
+                    'rejected': self.rejected}
+
+class StageScheduler(object):
+    # Separate pools of slots per stage, e.g. LLM generation, geocoding,
+    # video search and map rendering, so slow stages can not starve the
+    # quick ones.
+
+    def __init__(self, limits, max_waiting=64, per_session=2, wait_timeout=60):
+        # limits: stage name -> concurrent calls
+        self.stages = {
+            name: Stage(name, limit, max_waiting, per_session, wait_timeout)
+            for name, limit in limits.items()
+        }
+        metrics.gauge('stage_active', 'Calls of a stage running.', ['stage'],
+                      lambda: self._stats('active'))
+        metrics.gauge('stage_queue_depth', 'Calls waiting for a stage slot.',
+                      ['stage'], lambda: self._stats('waiting'))
+        # Rejections are counted in stage_errors_total of <stage>_queue.
+
+    def _stats(self, key):
+        return {(name, ): s.stats()[key] for name, s in self.stages.items()}
+
+    def stats(self):
+        return {name: s.stats() for name, s in self.stages.items()}
+
+    @contextmanager
+    def slot(self, stage, session=None):
+        # Raises StageBusy if no slot can be had.
+        if session is None:
+            session = current_session.get()
+        stage = self.stages[stage]
+        wait = stage.acquire(session)
+        if wait > 1:
+            logger.info(f'Waited {wait:.2f}s for a slot of {stage.name}.')
+        try:
+            yield
+        finally:
+            stage.release(session)
+
+    def limited(self, stage):
+        # Runs the decorated function, or generator, holding a slot.
+        def decorator(fn):
+            if inspect.isgeneratorfunction(fn):
+                @functools.wraps(fn)
+                def gen_wrapper(*args, **kwargs):
+                    with self.slot(stage):
+                        yield from fn(*args, **kwargs)
+                return gen_wrapper
+
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                with self.slot(stage):
+                    return fn(*args, **kwargs)
+            return wrapper
+        return decorator
+
+def in_session(gen, session):
+    # Runs every step of the generator with current_session set to session.
+    # Gradio may run the steps in different threads, where a session set by
+    # an earlier step is lost.
+    context = contextvars.copy_context()
+    context.run(current_session.set, session)
+    while True:
+        try:
+            value = context.run(next, gen)
+        except StopIteration:
+            return
+        yield value
@@ -0,0 +1,39 @@
+import os
+import subprocess
+import sys
+
+from gazetteer_util import Gazetteer
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def make_gazetteer(names):
+    gazetteer = Gazetteer()
+    gazetteer.add_city('442000', {
+        'names': names,
+        'lons': [113.0 + i for i in range(len(names))],
+        'lats': [22.0 + i for i in range(len(names))],
+    })
+    return gazetteer
+
+def test_exact_name_wins_over_stripped_alias():
+    gazetteer = make_gazetteer(['中山公园', '中山博物馆', '中山'])
+    assert gazetteer.lookup('中山公园', '442000') == '113.000000,22.000000'
+    assert gazetteer.lookup('中山博物馆', '442000') == '114.000000,23.000000'
+    # 中山 is the exact name of the third attraction, not an alias.
+    assert gazetteer.lookup('中山', '442000') == '115.000000,24.000000'
+    # Without a suffix the first attraction of that name is taken.
+    assert gazetteer.lookup('中山景区', '442000') == '115.000000,24.000000'
+
+def test_lookup_does_not_depend_on_hash_seed():
+    code = ('from gazetteer_util import Gazetteer\n'
+            'g = Gazetteer()\n'
+            "g.add_city('1', {'names': ['中山公园', '中山博物馆'],"
+            " 'lons': [1, 2], 'lats': [1, 2]})\n"
+            "print(g.lookup('中山博物馆', '1'), g.lookup('中山', '1'))\n")
+    outputs = set()
+    for seed in range(8):
+        env = dict(os.environ, PYTHONHASHSEED=str(seed))
+        outputs.add(subprocess.run(
+            [sys.executable, '-c', code], cwd=ROOT_DIR, env=env,
+            capture_output=True, text=True, check=True).stdout)
+    assert outputs == {'2.000000,2.000000 1.000000,1.000000\n'}
@@ -0,0 +1,22 @@
+import gradio as gr
+
+from map_util import MapFigureCache, SerializedFigure, plot_markers_map
+
+TRACES = [{
+    'trace': '第1天',
+    'locations': ['120.15,30.28', '120.16,30.25'],
+    'addresses': ['西湖', '雷峰塔'],
+}]
+
+def test_cached_figure_renders_like_the_figure():
+    # SerializedFigure relies on gr.Plot.postprocess calling to_json() on
+    # anything that is not matplotlib, bokeh or altair.
+    cache = MapFigureCache()
+    cached = cache.plot(TRACES)
+    assert isinstance(cached, SerializedFigure)
+    assert cache.plot(TRACES) is cached
+
+    expected = gr.Plot().postprocess(plot_markers_map(TRACES))
+    rendered = gr.Plot().postprocess(cached)
+    assert rendered.type == expected.type == 'plotly'
+    assert rendered.plot == expected.plot
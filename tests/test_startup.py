@@ -0,0 +1,19 @@
+import os
+import sys
+import tempfile
+from unittest import mock
+
+sys.path.insert(0, os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'benchmark'))
+
+from bench_startup import STARTUP_BUDGET, import_app
+from bench_trip import setup_env
+
+def test_import_app_is_lazy_and_within_budget():
+    with mock.patch.dict(os.environ):
+        # Nothing listens here, any call made at start fails.
+        setup_env('http://127.0.0.1:9', 'yi,qwen,intern',
+                  tempfile.mkdtemp(prefix='wego-startup-'))
+        result, _ = import_app(dict(os.environ))
+    assert result['loaded'] == []
+    assert result['seconds'] <= STARTUP_BUDGET
@@ -0,0 +1,180 @@
+import json
+import time
+
+import requests
+
+from retry_util import CircuitBreaker, REASON_PARSE, REASON_TIMEOUT
+from trip_advisor import GenerationFailure, HedgedTripAdvisor, TripAdvisor
+
+RESET_TIMEOUT = 0.05
+TRIP = {'city': '杭州'}
+ADVISE = {'city': '杭州', 'days': [{'date': '第1天', 'schedule': []}]}
+
+class FakeAdvisor(TripAdvisor):
+    # Times out until fail is set to False. With chunk_delay the advise is
+    # streamed in chunks, otherwise only generate_advise is implemented.
+    # With fail_after the stream breaks after that many chunks.
+
+    def __init__(self, name, threshold=2, chunk_delay=None, fail_after=None):
+        self.circuit_breaker = CircuitBreaker(
+            name, failure_threshold=threshold, reset_timeout=RESET_TIMEOUT)
+        self.chunk_delay = chunk_delay
+        self.fail_after = fail_after
+        self.fail = True
+        self.calls = 0
+
+    def generate_advise(self, trip):
+        self.calls += 1
+        if self.fail:
+            return GenerationFailure(REASON_TIMEOUT, 'timeout')
+        return dict(ADVISE)
+
+    def stream_text(self, trip):
+        if self.chunk_delay is None:
+            return
+        self.calls += 1
+        if self.fail:
+            raise requests.Timeout('timeout')
+        text = json.dumps(ADVISE, ensure_ascii=False)
+        for i in range(0, len(text), 8):
+            if self.fail_after is not None and i >= 8 * self.fail_after:
+                raise requests.ConnectionError('connection reset')
+            time.sleep(self.chunk_delay)
+            yield text[i:i + 8]
+
+def open_circuit(advisor):
+    for _ in range(advisor.circuit_breaker.failure_threshold):
+        advisor.circuit_breaker.record_failure(REASON_TIMEOUT)
+    assert advisor.circuit_breaker.state == CircuitBreaker.OPEN
+
+def wait_reset():
+    time.sleep(RESET_TIMEOUT * 1.5)
+
+def test_stream_advise_opens_circuit_of_non_streaming_backend():
+    advisor = FakeAdvisor('intern')
+    for _ in range(10):
+        assert not list(advisor.stream_advise(TRIP))[-1]
+    assert advisor.circuit_breaker.state == CircuitBreaker.OPEN
+    assert advisor.calls == 2
+
+def test_stream_advise_trial_closes_circuit():
+    advisor = FakeAdvisor('intern')
+    open_circuit(advisor)
+    wait_reset()
+    advisor.fail = False
+    assert list(advisor.stream_advise(TRIP))[-1]
+    assert advisor.circuit_breaker.state == CircuitBreaker.CLOSED
+    assert advisor.calls == 1
+
+def test_stream_advise_failed_trial_reopens_circuit():
+    advisor = FakeAdvisor('yi', chunk_delay=0)
+    open_circuit(advisor)
+    opened_at = advisor.circuit_breaker.opened_at
+    wait_reset()
+    assert not list(advisor.stream_advise(TRIP))[-1]
+    assert advisor.circuit_breaker.state == CircuitBreaker.OPEN
+    assert advisor.circuit_breaker.opened_at > opened_at
+    # Open again, nothing goes through until the next reset.
+    assert not list(advisor.stream_advise(TRIP))[-1]
+    assert advisor.calls == 1
+
+def test_bad_output_gives_back_trial():
+    breaker = CircuitBreaker('qwen', failure_threshold=1,
+                             reset_timeout=RESET_TIMEOUT)
+    breaker.record_failure(REASON_TIMEOUT)
+    wait_reset()
+    assert breaker.allow()
+    breaker.record_failure(REASON_PARSE)
+    assert breaker.state == CircuitBreaker.OPEN
+    assert breaker.allow()
+
+def test_stream_advise_closed_early_gives_back_trial():
+    advisor = FakeAdvisor('yi', chunk_delay=0)
+    open_circuit(advisor)
+    wait_reset()
+    advisor.fail = False
+    stream = advisor.stream_advise(TRIP)
+    assert next(stream)['partial']
+    stream.close()
+    assert advisor.circuit_breaker.state == CircuitBreaker.OPEN
+    assert advisor.circuit_breaker.allow()
+    assert advisor.circuit_breaker.state == CircuitBreaker.HALF_OPEN
+
+def test_hedged_keeps_trial_of_backends_not_fired():
+    a, b = FakeAdvisor('a'), FakeAdvisor('b')
+    hedged = HedgedTripAdvisor({'a': a, 'b': b}, default_deadline=10)
+    open_circuit(a)
+    open_circuit(b)
+    wait_reset()
+    a.fail = False
+    for _ in range(5):
+        assert hedged.generate_advise(TRIP)
+    assert a.circuit_breaker.state == CircuitBreaker.CLOSED
+    assert b.calls == 0
+    assert b.circuit_breaker.state == CircuitBreaker.OPEN
+    assert b.circuit_breaker.ready()
+
+    # Once a fails, b gets its trial and recovers.
+    a.fail, b.fail = True, False
+    for _ in range(3):
+        assert hedged.generate_advise(TRIP)
+    assert b.circuit_breaker.state == CircuitBreaker.CLOSED
+
+def test_hedged_cancelled_trial_goes_back_to_open():
+    a = FakeAdvisor('a', chunk_delay=0.001)
+    b = FakeAdvisor('b', chunk_delay=0.05)
+    a.fail = b.fail = False
+    hedged = HedgedTripAdvisor({'a': a, 'b': b}, default_deadline=0)
+    open_circuit(b)
+    wait_reset()
+    assert hedged.generate_advise(TRIP)
+    hedged.executor.shutdown(wait=True)
+    assert b.calls == 1
+    assert b.circuit_breaker.state == CircuitBreaker.OPEN
+    assert b.circuit_breaker.allow()
+
+def test_hedged_streams_days_of_fastest_backend():
+    a = FakeAdvisor('a', chunk_delay=0.05)
+    b = FakeAdvisor('b', chunk_delay=0.001)
+    a.fail = b.fail = False
+    hedged = HedgedTripAdvisor({'a': a, 'b': b}, default_deadline=0.01)
+    results = list(hedged.stream_advise(TRIP))
+    assert results[0]['partial']
+    assert results[-1] == ADVISE
+    hedged.executor.shutdown(wait=True)
+    assert a.calls == b.calls == 1
+    # a lost the stream and was stopped, only the winner counts.
+    assert hedged.stats['b'].successes == 1
+    assert hedged.stats['a'].successes == 0
+
+def test_hedged_stream_falls_back_to_non_streaming_backend():
+    a = FakeAdvisor('a', chunk_delay=0)
+    b = FakeAdvisor('b')
+    b.fail = False
+    hedged = HedgedTripAdvisor({'a': a, 'b': b}, default_deadline=10)
+    assert list(hedged.stream_advise(TRIP))[-1] == ADVISE
+    assert a.circuit_breaker.failures == 1
+    assert b.calls == 1
+
+def test_hedged_stream_switches_to_loser_when_leader_fails():
+    # b is hedged before a streams, a leads and breaks half way.
+    a = FakeAdvisor('a', chunk_delay=0.01, fail_after=6)
+    b = FakeAdvisor('b', chunk_delay=0.02)
+    a.fail = b.fail = False
+    hedged = HedgedTripAdvisor({'a': a, 'b': b}, default_deadline=0.001)
+    results = list(hedged.stream_advise(TRIP))
+    assert results[-1] == ADVISE
+    hedged.executor.shutdown(wait=True)
+    # b kept running while a led the stream, nothing was generated again.
+    assert a.calls == b.calls == 1
+    assert hedged.stats['b'].successes == 1
+    assert a.circuit_breaker.failures == 1
+
+def test_hedged_stream_fires_next_backend_when_leader_fails():
+    a = FakeAdvisor('a', chunk_delay=0, fail_after=6)
+    b = FakeAdvisor('b', chunk_delay=0)
+    a.fail = b.fail = False
+    hedged = HedgedTripAdvisor({'a': a, 'b': b}, default_deadline=10)
+    assert list(hedged.stream_advise(TRIP))[-1] == ADVISE
+    hedged.executor.shutdown(wait=True)
+    assert a.calls == b.calls == 1
@@ -6,19 +6,43 @@
 # Last Modified Date: 18.03.2024
 # Last Modified By  : Yan <yanwong@126.com>
 
-from collections import namedtuple
+from collections import Counter, deque, namedtuple
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from http import HTTPStatus
 import json
+import math
 import os
+import queue
 import re
 import logging
+import threading
+import time
 
-import requests
-import dashscope
-import openxlab
+from credential_util import TokenManager
+from http_util import get_http_client, iter_sse_data
+from json_util import ArrayItemStreamParser, repair_loads
+from metrics_util import metrics, timed
+from retry_util import (
+    REASON_AUTH, REASON_CIRCUIT_OPEN, REASON_INVALID_REQUEST, REASON_PARSE,
+    REASON_QUOTA, REASON_RATE_LIMIT, REASON_SERVER, REASON_TOKEN_EXPIRED,
+    REASON_UNKNOWN,
+    CircuitBreaker, classify_exception, classify_status
+)
 
 logger = logging.getLogger(__name__)
 
+# How often each kind of JSON repair was needed, see json_util.
+JSON_REPAIR_COUNTS = Counter()
+metrics.gauge(
+    'json_repairs', 'LLM outputs needing each kind of JSON repair.', ['repair'],
+    lambda: {(k, ): v for k, v in JSON_REPAIR_COUNTS.items()})
+
+def count_usage(backend, usage, input_key, output_key):
+    # Token usage as reported by the provider.
+    if usage:
+        metrics.count_tokens(
+            backend, usage.get(input_key) or 0, usage.get(output_key) or 0)
+
 Prompt = namedtuple('Prompt', ['name', 'instruction', 'examples'])
 
 TRIP_ADVISE_PROMPT = Prompt(
@@ -166,59 +190,321 @@ TRIP_ADVISE_PROMPT = Prompt(
     ]
 )
 
+def format_trip_brief(trip):
+    city = '目的地:' + trip['city']
+    duration = '\n旅游天数:' + trip['duration']
+    weather = '\n天气情况:'
+    for i, w in enumerate(trip['weathers']):
+        weather += f'第{i+1}天'
+        day_weather, night_weather = w['day_weather'], w['night_weather']
+        weather += f'白天{day_weather}, 晚上{night_weather}。'
+    return city + duration + weather
+
+def compile_prompt_prefix(prompt):
+    prefix = prompt.instruction
+    if prompt.examples:
+        prefix += '\n以下是根据出行信息制定旅游攻略的示例。'
+        for i, example in enumerate(prompt.examples):
+            prefix += f'\n示例{i+1}:'
+            example_brief = format_trip_brief(example)
+            example_advise = json.dumps(
+                example['trip_advise'], ensure_ascii=False).encode('utf8').decode()
+            prefix += f'\n出行信息如下:\n{example_brief}\n旅游攻略如下:\n{example_advise}'
+    return prefix
+
+def estimate_tokens(text):
+    # One token per CJK character and per 4 others.
+    cjk = len(re.findall(r'[\u3000-\u303f\u4e00-\u9fff\uff00-\uffef]', text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+class GenerationFailure(dict):
+    # Returned by generate_advise instead of an advise. It is an empty dict,
+    # so `if not advise` keeps working, carrying why generation failed.
+
+    def __init__(self, reason, message=''):
+        super().__init__()
+        self.reason = reason
+        self.message = message
+
+    def __repr__(self):
+        return f'GenerationFailure({self.reason!r}, {self.message!r})'
+
+class GenerationError(Exception):
+    def __init__(self, reason, message=''):
+        super().__init__(message)
+        self.reason = reason
+
+# The instruction and examples never change, so they are compiled once and
+# sent as the leading segment of every request. Providers with prefix (KV)
+# caching can then reuse the work done on it.
+TRIP_ADVISE_PREFIX = compile_prompt_prefix(TRIP_ADVISE_PROMPT)
+TRIP_ADVISE_REQUEST = '请你根据以下出行信息制定旅游攻略:'
+TRIP_REPAIR_REQUEST = (
+    '\n以下是已经制定好的其他几天的行程，请保持不变，并且不要重复其中的景点:\n'
+    '{kept_days}\n请你只制定{repair_days}的行程，用合法的JSON格式返回结果，'
+    '格式为{{"days": [...]}}，不要添加注释。'
+)
+
+SCHEDULE_FIELDS = ('time', 'location', 'description')
+MAX_SCHEDULE_ITEMS = 5
+
+def validate_advise(advise, num_days):
+    # Returns {day index: [problems]} for every invalid day of the advise,
+    # an empty dict means the advise is valid.
+    days = advise.get('days') if isinstance(advise, dict) else None
+    if not isinstance(days, list):
+        return {i: ['missing days'] for i in range(num_days)}
+
+    invalid = {}
+    seen_locations = set()
+    for i in range(num_days):
+        if i >= len(days):
+            invalid[i] = ['missing day']
+            continue
+
+        day, problems = days[i], []
+        schedule = day.get('schedule') if isinstance(day, dict) else None
+        if not isinstance(schedule, list) or not schedule:
+            invalid[i] = ['empty schedule']
+            continue
+        if len(schedule) > MAX_SCHEDULE_ITEMS:
+            problems.append(f'{len(schedule)} schedule items')
+
+        locations = set()
+        for sch in schedule:
+            if not isinstance(sch, dict) or not all(
+                    isinstance(sch.get(f), str) and sch[f].strip()
+                    for f in SCHEDULE_FIELDS):
+                problems.append(f'malformed schedule item: {sch}')
+                continue
+            location = sch['location'].strip()
+            if location in seen_locations:
+                problems.append(f'location visited before: {location}')
+            locations.add(location)
+
+        seen_locations |= locations
+        if problems:
+            invalid[i] = problems
+    return invalid
+
 class TripAdvisor(object):
+    _prefix_tokens = None
+    circuit_breaker = None
+
     def get_trip_brief(self, trip):
-        city = '目的地:' + trip['city']
-        duration = '\n旅游天数:' + trip['duration']
-        weather = '\n天气情况:'
-        for i, w in enumerate(trip['weathers']):
-            weather += f'第{i+1}天'
-            day_weather, night_weather = w['day_weather'], w['night_weather']
-            weather += f'白天{day_weather}, 晚上{night_weather}。'
-        return city + duration + weather
+        return format_trip_brief(trip)
+
+    def create_trip_message(self, trip):
+        message = TRIP_ADVISE_REQUEST + '\n' + self.get_trip_brief(trip)
+        if trip.get('repair_days'):
+            kept_days = json.dumps(trip['kept_days'], ensure_ascii=False)
+            repair_days = '、'.join(f'第{i+1}天' for i in trip['repair_days'])
+            message += TRIP_REPAIR_REQUEST.format(
+                kept_days=kept_days, repair_days=repair_days)
+        return message
 
     def create_prompt(self, trip):
-        prompt = TRIP_ADVISE_PROMPT.instruction
-        if TRIP_ADVISE_PROMPT.examples:
-            prompt += '\n以下是根据出行信息制定旅游攻略的示例。'
-            for i, example in enumerate(TRIP_ADVISE_PROMPT.examples):
-                prompt += f'\n示例{i+1}:'
-                example_brief = self.get_trip_brief(example)
-                example_advise = json.dumps(
-                    example['trip_advise'], ensure_ascii=False).encode('utf8').decode()
-                prompt += f'\n出行信息如下:\n{example_brief}\n旅游攻略如下:\n{example_advise}'
-        prompt += '\n请你根据以下出行信息制定旅游攻略:'
-        prompt += '\n' + self.get_trip_brief(trip)
-        return prompt
+        return TRIP_ADVISE_PREFIX + '\n' + self.create_trip_message(trip)
+
+    def create_messages(self, trip):
+        return [
+            {'role': 'system', 'content': TRIP_ADVISE_PREFIX},
+            {'role': 'user', 'content': self.create_trip_message(trip)}
+        ]
+
+    def count_tokens(self, text):
+        return estimate_tokens(text)
+
+    def count_prompt_tokens(self, trip):
+        # The prefix is counted once per backend class.
+        cls = type(self)
+        if cls._prefix_tokens is None:
+            cls._prefix_tokens = self.count_tokens(TRIP_ADVISE_PREFIX)
+        trip_tokens = self.count_tokens(self.create_trip_message(trip))
+        return cls._prefix_tokens, trip_tokens
+
+    def log_prompt_tokens(self, trip):
+        prefix_tokens, trip_tokens = self.count_prompt_tokens(trip)
+        logger.info('{} prompt tokens: prefix {}, trip {}'.format(
+            self.__class__.__name__, prefix_tokens, trip_tokens))
+        return prefix_tokens, trip_tokens
+
+    def try_generate_advise(self, trip):
+        # generate_advise guarded by the backend's circuit breaker.
+        breaker = self.circuit_breaker
+        if breaker is not None and not breaker.allow():
+            return GenerationFailure(
+                REASON_CIRCUIT_OPEN, f'Circuit of {breaker.name} is open')
+
+        advise = self.generate_advise(trip)
+        self.record_outcome(advise)
+        return advise
+
+    def record_outcome(self, advise):
+        breaker = self.circuit_breaker
+        if breaker is None:
+            return
+        if advise:
+            breaker.record_success()
+        else:
+            breaker.record_failure(getattr(advise, 'reason', REASON_UNKNOWN))
+
+    def repair_advise(self, trip, advise, invalid_days):
+        # Regenerates only the invalid days, with the valid ones as context.
+        # A much smaller output than a full plan, so much faster.
+        num_days = len(trip['weathers'])
+        days = list(advise.get('days') or [])[:num_days]
+        days += [None] * (num_days - len(days))
+        kept_days = [d for i, d in enumerate(days) if i not in invalid_days]
+        repair_trip = dict(
+            trip, repair_days=sorted(invalid_days), kept_days=kept_days)
+
+        logger.info('Repair days {} of the advise.'.format(
+            [i + 1 for i in sorted(invalid_days)]))
+        fix = self.try_generate_advise(repair_trip)
+        if not fix:
+            return fix
+        fixed_days = fix.get('days') if isinstance(fix, dict) else None
+        if not isinstance(fixed_days, list):
+            return GenerationFailure(REASON_PARSE, 'No days in repaired advise')
+
+        for i, day in zip(sorted(invalid_days), fixed_days):
+            if isinstance(day, dict):
+                day['date'] = f'第{i+1}天'
+            days[i] = day
+        repaired = dict(advise)
+        repaired['days'] = days
+        return repaired
+
+    def parse_advise(self, text):
+        # Sometimes the text not only contains valid JSON but also contains
+        # some contents like ```json {} ```, comments or a truncated tail.
+        # Stupid LLM. Fixing them locally is far cheaper than regenerating.
+        advise, repairs = repair_loads(text)
+        if repairs:
+            logger.warning('{} output repaired: {}'.format(
+                self.__class__.__name__, ', '.join(repairs)))
+            JSON_REPAIR_COUNTS.update(repairs)
+        return advise
+
+    def stream_text(self, trip):
+        # Backends supporting streaming yield text chunks as they are
+        # generated, others yield nothing and stream_advise falls back to
+        # generate_advise.
+        return iter(())
+
+    def stream_advise(self, trip):
+        # Yields the advise generated so far each time a day is completed,
+        # these partial advises are marked with 'partial': True. The last
+        # yield is the complete advise, or a GenerationFailure.
+        if not trip:
+            logger.warning('No trip brief provided to generate advise.')
+            yield GenerationFailure(REASON_INVALID_REQUEST, 'No trip brief')
+            return
+
+        breaker = self.circuit_breaker
+        permit = breaker.permit() if breaker is not None else None
+        if breaker is not None and permit is None:
+            yield GenerationFailure(
+                REASON_CIRCUIT_OPEN, f'Circuit of {breaker.name} is open')
+            return
+
+        parser = ArrayItemStreamParser('days')
+        chunks, days = [], []
+        recorded = False
+        try:
+            try:
+                for chunk in self.stream_text(trip):
+                    chunks.append(chunk)
+                    new_days = parser.feed(chunk)
+                    if new_days:
+                        days.extend(new_days)
+                        yield {'city': trip['city'], 'days': list(days),
+                               'partial': True}
+            except Exception as e:
+                logger.error('{} streaming failed: {}'.format(
+                    self.__class__.__name__, e))
+                reason = classify_exception(e)
+                if breaker is not None:
+                    breaker.record_failure(reason)
+                recorded = True
+                yield GenerationFailure(reason, str(e))
+                return
+
+            if not chunks:
+                # Not a streaming backend, the permit taken above covers
+                # generate_advise.
+                advise = self.generate_advise(trip)
+                self.record_outcome(advise)
+                recorded = True
+                yield advise
+                return
+
+            if breaker is not None:
+                breaker.record_success()
+            recorded = True
+        finally:
+            # Closed by the consumer before the backend finished.
+            if breaker is not None and not recorded:
+                breaker.release(permit)
+
+        text = ''.join(chunks)
+        logger.info('{} streamed output: {}'.format(
+            self.__class__.__name__, text))
+        try:
+            advise = self.parse_advise(text)
+        except Exception as e:
+            logger.error('Parse streamed advise failed: {}'.format(e))
+            advise = GenerationFailure(classify_exception(e), str(e))
+        yield advise
 
 class QwenTripAdvisor(TripAdvisor):
-    def __init__(self, model_name):
+    _tokenizer = None
+
+    def __init__(self, model_name, request_timeout=120, http_client=None):
         self.model_name = model_name  # e.g. qwen-max, qwen-max-longcontext
+        # dashscope manages its own HTTP session, only the timeout and the
+        # rate limit of the shared client apply.
+        self.request_timeout = request_timeout
+        self.http = http_client or get_http_client()
+        self.circuit_breaker = CircuitBreaker('qwen')
 
+    def count_tokens(self, text):
+        # Counts with the local Qwen tokenizer when tiktoken is installed,
+        # otherwise estimates.
+        if QwenTripAdvisor._tokenizer is None:
+            try:
+                from dashscope.tokenizers import get_tokenizer
+                QwenTripAdvisor._tokenizer = get_tokenizer('qwen-max')
+            except Exception as e:
+                logger.info('Qwen tokenizer unavailable, estimate tokens: {}'.format(e))
+                QwenTripAdvisor._tokenizer = False
+        if QwenTripAdvisor._tokenizer:
+            return len(QwenTripAdvisor._tokenizer.encode(text))
+        return estimate_tokens(text)
+
+    @timed('qwen_generate')
     def generate_advise(self, trip):
-        advise = {}
         if not trip:
             logger.warning('No trip brief provided to generate advise.')
-            return advise
-        prompt = self.create_prompt(trip)
+            return GenerationFailure(REASON_INVALID_REQUEST, 'No trip brief')
+        self.log_prompt_tokens(trip)
         try:
+            import dashscope
+            self.http.throttle(dashscope.base_http_api_url)
             response = dashscope.Generation.call(
                 model=self.model_name,
-                prompt=prompt
+                messages=self.create_messages(trip),
+                result_format='text',
+                request_timeout=self.request_timeout
             )
             if response.status_code == HTTPStatus.OK:
                 logger.info(
                     'Qwen output: {}, usage info: {}'.format(
                         response.output, response.usage)
                 )
-                text = response.output['text']
-                # Sometimes the text not only contains valid JSON but also
-                # contains some contents like ```json {} ```. Stupid LLM.
-                m = re.search(r'```json(.*)```', text, re.DOTALL)
-                if m:
-                    text = m.group(1)
-
-                advise = json.loads(text)
+                count_usage('qwen', response.usage, 'input_tokens', 'output_tokens')
+                advise = self.parse_advise(response.output['text'])
             else:
                 logger.error(
                     'Qwen request failed. Request id: {}, status code: {},'
@@ -226,32 +512,87 @@ class QwenTripAdvisor(TripAdvisor):
                         response.request_id, response.status_code,
                         response.code, response.message)
                 )
+                advise = GenerationFailure(
+                    classify_status(response.status_code), response.message)
         except Exception as e:
             logger.error('Qwen generation failed: {}'.format(e))
+            advise = GenerationFailure(classify_exception(e), str(e))
 
         return advise
 
+    @timed('qwen_stream')
+    def stream_text(self, trip):
+        import dashscope
+        self.log_prompt_tokens(trip)
+        self.http.throttle(dashscope.base_http_api_url)
+        responses = dashscope.Generation.call(
+            model=self.model_name,
+            messages=self.create_messages(trip),
+            result_format='text',
+            stream=True,
+            incremental_output=True,
+            request_timeout=self.request_timeout
+        )
+        usage = None
+        for response in responses:
+            if response.status_code != HTTPStatus.OK:
+                raise GenerationError(
+                    classify_status(response.status_code),
+                    'Qwen request failed. Request id: {}, status code: {},'
+                    ' error code: {}, error message: {}'.format(
+                        response.request_id, response.status_code,
+                        response.code, response.message)
+                )
+            # Usage of incremental output counts all tokens so far.
+            usage = response.usage or usage
+            yield response.output['text']
+        count_usage('qwen', usage, 'input_tokens', 'output_tokens')
+
 class InternTripAdvisor(TripAdvisor):
-    def __init__(self, model_name, model_url, temperature=0.95, top_p=0.9):
-        self.access_key = os.environ['OPENXLAB_AK']
-        self.secret_key = os.environ['OPENXLAB_SK']
+    def __init__(self, model_name, model_url, temperature=0.95, top_p=0.9,
+                 http_client=None, request_timeout=(3.05, 120), auth_url=None):
+        self.http = http_client or get_http_client()
+        self.request_timeout = request_timeout
         self.model_url = model_url
         self.model_name = model_name
         self.temperature = temperature
         self.top_p = top_p
+        # SSO endpoint of openxlab, None keeps the one built into the SDK.
+        self.auth_url = auth_url
 
-        openxlab.login(ak=self.access_key, sk=self.secret_key)
+        self.tokens = TokenManager('openxlab', self._fetch_token)
+        self.circuit_breaker = CircuitBreaker('intern')
+
+    def _fetch_token(self):
+        # The SDK is imported with the first token, not at start. get_token
+        # signs in with the keys itself, openxlab.login would only do the
+        # same call once more and store the keys in the home directory.
+        from openxlab.utils.time_util import get_datetime_from_formatted_str
+        from openxlab.xlab.clients.auth_client import AuthClient
+        from openxlab.xlab.handler import user_token
+
+        if self.auth_url:
+            user_token.AUTH_CLIENT = AuthClient(self.auth_url)
+        token = user_token.get_token(
+            os.environ['OPENXLAB_AK'], os.environ['OPENXLAB_SK'])
+        expires_at = get_datetime_from_formatted_str(
+            token.expiration).timestamp()
+        return token.jwt, expires_at
 
     def _get_token(self):
-        return openxlab.xlab.handler.user_token.get_jwt(self.access_key,
-                                                        self.secret_key)
+        try:
+            return self.tokens.get_token()
+        except Exception as e:
+            logger.error('Get openxlab jwt failed: {}'.format(e))
+        return None
 
+    @timed('intern_generate')
     def generate_advise(self, trip):
-        advise = {}
         if not trip:
             logger.warning('No trip brief provided to generate advise.')
-            return advise
+            return GenerationFailure(REASON_INVALID_REQUEST, 'No trip brief')
         prompt = self.create_prompt(trip)
+        self.log_prompt_tokens(trip)
         headers = {
             'Authorization': self._get_token(),
             'Content-Type': 'application/json'
@@ -263,65 +604,98 @@ class InternTripAdvisor(TripAdvisor):
             'top_p': self.top_p
         }
         try:
-            response = requests.post(self.model_url, headers=headers,
-                                     data=json.dumps(payload))
+            response = self.http.post(self.model_url, headers=headers,
+                                      data=json.dumps(payload),
+                                      timeout=self.request_timeout)
             content = response.json()
             if response.status_code == HTTPStatus.OK:
                 logger.info('InternLM output: {}'.format(content))
+                count_usage('intern', content['data'].get('usage'),
+                            'prompt_tokens', 'completion_tokens')
 
                 text = content['data']['choices'][0]['text']
-                m = re.search(r'{.+}', text, re.DOTALL)
-                if m:
-                    text = m.group(0)
-
-                advise = json.loads(text)
+                advise = self.parse_advise(text)
             else:
+                reason = classify_status(response.status_code)
+                if response.status_code == HTTPStatus.UNAUTHORIZED:
+                    # Most likely the cached jwt expired, a retry gets a new one.
+                    self.tokens.invalidate()
+                    reason = REASON_TOKEN_EXPIRED
                 logger.error(
                     'InternLM request failed. Status code: {},'
                     ' code: {}, message: {}, error: {}'.format(
                         response.status_code, content['code'], content['msg'],
                         content['error'])
                 )
+                advise = GenerationFailure(reason, content['msg'])
         except Exception as e:
             logger.error(f'InternLM generation failed: {e}')
+            advise = GenerationFailure(classify_exception(e), str(e))
 
         return advise
 
 class YiTripAdvisor(TripAdvisor):
+    # https://cloud.baidu.com/doc/WENXINWORKSHOP/s/tlmyncueh
+    ERROR_REASONS = {
+        2: REASON_SERVER, 4: REASON_RATE_LIMIT, 6: REASON_AUTH,
+        13: REASON_AUTH, 14: REASON_AUTH, 17: REASON_QUOTA,
+        18: REASON_RATE_LIMIT, 19: REASON_QUOTA, 100: REASON_INVALID_REQUEST,
+        110: REASON_TOKEN_EXPIRED, 111: REASON_TOKEN_EXPIRED,
+        336000: REASON_SERVER, 336001: REASON_INVALID_REQUEST,
+        336002: REASON_INVALID_REQUEST, 336003: REASON_INVALID_REQUEST,
+        336100: REASON_SERVER
+    }
+
     def __init__(self, auth_url, model_url, temperature=0.9, top_p=0.8,
-                 penalty_score=2.0):
+                 penalty_score=2.0, http_client=None,
+                 request_timeout=(3.05, 120)):
+        self.http = http_client or get_http_client()
+        self.request_timeout = request_timeout
         self.auth_url = auth_url
         self.model_url = model_url
         self.temperature = temperature
         self.top_p = top_p
         self.penalty_score = penalty_score
-        self.api_key = os.environ['BAIDU_API_KEY']
-        self.secret_key = os.environ['BAIDU_SK']
+        self.tokens = TokenManager('baidu', self._fetch_token)
+        self.circuit_breaker = CircuitBreaker('yi')
 
-    def _get_token(self):
+    def _error_reason(self, error_code):
+        reason = YiTripAdvisor.ERROR_REASONS.get(error_code, REASON_UNKNOWN)
+        if reason == REASON_TOKEN_EXPIRED:
+            self.tokens.invalidate()
+        return reason
+
+    def _fetch_token(self):
         headers = {
             'Content-Type': 'application/json',
             'Accept': 'application/json'
         }
         payload = {
             'grant_type': 'client_credentials',
-            'client_id': self.api_key,
-            'client_secret': self.secret_key
+            'client_id': os.environ['BAIDU_API_KEY'],
+            'client_secret': os.environ['BAIDU_SK']
         }
 
+        response = self.http.post(self.auth_url, headers=headers, params=payload)
+        content = response.json()
+        expires_in = content.get('expires_in')
+        expires_at = time.time() + expires_in if expires_in else None
+        return content.get('access_token'), expires_at
+
+    def _get_token(self):
         try:
-            response = requests.post(self.auth_url, headers=headers, params=payload)
+            return self.tokens.get_token()
         except Exception as e:
             logger.error('Get access token failed: {}'.format(e))
+        return None
 
-        return response.json().get("access_token")
-
+    @timed('yi_generate')
     def generate_advise(self, trip):
-        advise = {}
         if not trip:
             logger.warning('No trip brief provided to generate advise.')
-            return advise
+            return GenerationFailure(REASON_INVALID_REQUEST, 'No trip brief')
         prompt = self.create_prompt(trip)
+        self.log_prompt_tokens(trip)
 
         headers = {'Content-Type': 'application/json'}
         params = {'access_token': self._get_token()}
@@ -335,24 +709,413 @@ class YiTripAdvisor(TripAdvisor):
         })
         advise = {}
         try:
-            response = requests.post(
-                self.model_url, params=params, headers=headers, data=data
+            response = self.http.post(
+                self.model_url, params=params, headers=headers, data=data,
+                timeout=self.request_timeout
             )
             content = response.json()
 
             if not content.get('error_code'):
                 logger.info('Yi output: {}'.format(content))
-                text = content['result']
-                m = re.search(r'{.+}', text, re.DOTALL)
-                if m:
-                    text = m.group(0)
-                advise = json.loads(text)
+                count_usage('yi', content.get('usage'),
+                            'prompt_tokens', 'completion_tokens')
+                advise = self.parse_advise(content['result'])
             else:
                 logger.error('Yi request failed. '
                              'Error code: {}, error message: {}'.format(
-                                 response['error_code'], response['error_msg']))
+                                 content['error_code'], content['error_msg']))
+                advise = GenerationFailure(
+                    self._error_reason(content['error_code']),
+                    content['error_msg'])
         except Exception as e:
             logger.error('Yi generation failed: {}'.format(e))
+            advise = GenerationFailure(classify_exception(e), str(e))
 
         return advise
 
+    @timed('yi_stream')
+    def stream_text(self, trip):
+        prompt = self.create_prompt(trip)
+        self.log_prompt_tokens(trip)
+        headers = {'Content-Type': 'application/json'}
+        params = {'access_token': self._get_token()}
+        data = json.dumps({
+            'messages': [{'role': 'user', 'content': prompt}],
+            'stream': True
+        })
+        response = self.http.post(
+            self.model_url, params=params, headers=headers, data=data,
+            timeout=self.request_timeout, stream=True
+        )
+        with response:
+            # Errors come back as a plain JSON body instead of an event stream.
+            if 'text/event-stream' not in response.headers.get('Content-Type', ''):
+                content = response.json()
+                raise GenerationError(
+                    self._error_reason(content.get('error_code')),
+                    'Yi request failed. Error code: {}, error message: {}'.format(
+                        content.get('error_code'), content.get('error_msg')))
+
+            usage = None
+            for event in iter_sse_data(response):
+                content = json.loads(event)
+                if content.get('error_code'):
+                    raise GenerationError(
+                        self._error_reason(content['error_code']),
+                        'Yi request failed. Error code: {}, error message: {}'.format(
+                            content['error_code'], content.get('error_msg')))
+                usage = content.get('usage') or usage
+                yield content.get('result', '')
+                if content.get('is_end'):
+                    break
+            count_usage('yi', usage, 'prompt_tokens', 'completion_tokens')
+
+
+class LazyTripAdvisor(object):
+    # Stands in for the advisor returned by factory, which is only called
+    # on first use. Until then the provider SDK is not imported, so an
+    # unused backend costs nothing at start.
+
+    def __init__(self, factory):
+        self.factory = factory
+        self._advisor = None
+        self._lock = threading.Lock()
+
+    def get(self):
+        if self._advisor is None:
+            with self._lock:
+                if self._advisor is None:
+                    self._advisor = self.factory()
+        return self._advisor
+
+    def __getattr__(self, name):
+        return getattr(self.get(), name)
+
+class BackendStats(object):
+    # Latencies of the recent successful generations of one backend.
+
+    def __init__(self, window=100):
+        self.latencies = deque(maxlen=window)
+        self.successes = 0
+        self.failures = 0
+        self._lock = threading.Lock()
+
+    def record(self, latency, success):
+        with self._lock:
+            if success:
+                self.successes += 1
+                self.latencies.append(latency)
+            else:
+                self.failures += 1
+
+    def percentile(self, p):
+        with self._lock:
+            latencies = sorted(self.latencies)
+        if not latencies:
+            return None
+        k = min(len(latencies) - 1, max(0, math.ceil(p * len(latencies)) - 1))
+        return latencies[k]
+
+    def failure_rate(self):
+        total = self.successes + self.failures
+        return self.failures / total if total else 0.0
+
+class HedgedTripAdvisor(TripAdvisor):
+    # Sends the request to the fastest backend first. If it has not produced
+    # a valid advise once its hedge_percentile latency has passed, or it
+    # fails, the next backend is tried in parallel. The first parsable
+    # advise wins and streaming losers are stopped at their next chunk.
+    # When streamed, the days of the first backend to produce a chunk are
+    # shown while the others keep running, see stream_advise.
+
+    def __init__(self, advisors, hedge_percentile=0.9, default_deadline=30,
+                 min_samples=5, max_workers=8):
+        self.advisors = advisors  # name -> TripAdvisor
+        self.hedge_percentile = hedge_percentile
+        self.default_deadline = default_deadline
+        self.min_samples = min_samples
+        self.stats = {name: BackendStats() for name in advisors}
+        self.executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix='hedged-advisor')
+
+    def _deadline(self, name):
+        stats = self.stats[name]
+        if len(stats.latencies) < self.min_samples:
+            return self.default_deadline
+        return stats.percentile(self.hedge_percentile)
+
+    def rank_backends(self):
+        # Unreliable backends go last, the rest by median latency.
+        def _score(name):
+            stats = self.stats[name]
+            p50 = stats.percentile(0.5)
+            return (stats.failure_rate() > 0.5,
+                    p50 if p50 is not None else self.default_deadline)
+        return sorted(self.advisors, key=_score)
+
+    def _ready_backends(self):
+        # Backends with an open circuit are left out of the race. Only
+        # backends actually fired take a permit, see _next_backend, so an
+        # expired circuit keeps its trial for a request that uses it.
+        return [
+            name for name in self.rank_backends()
+            if self.advisors[name].circuit_breaker is None or
+            self.advisors[name].circuit_breaker.ready()
+        ]
+
+    def _next_backend(self, backends):
+        # Pops the next backend of backends letting a request through.
+        # Returns its name and permit, or (None, None).
+        while backends:
+            name = backends.pop(0)
+            breaker = self.advisors[name].circuit_breaker
+            permit = breaker.permit() if breaker is not None else None
+            if breaker is not None and permit is None:
+                continue
+            logger.info(f'Send trip advise request to {name}.')
+            return name, permit
+        return None, None
+
+    def _cancel_backend(self, name, permit):
+        # A cancelled run has no outcome, a trial permit is given back.
+        logger.info(f'Cancelled generation of {name}.')
+        breaker = self.advisors[name].circuit_breaker
+        if breaker is not None:
+            breaker.release(permit)
+        return GenerationFailure(REASON_UNKNOWN, 'Cancelled')
+
+    def _run_backend(self, name, trip, cancelled, permit):
+        advisor = self.advisors[name]
+        start = time.monotonic()
+        chunks = []
+        advise = None
+        stream = advisor.stream_text(trip)
+        try:
+            for chunk in stream:
+                if cancelled.is_set():
+                    return self._cancel_backend(name, permit)
+                chunks.append(chunk)
+        except Exception as e:
+            logger.error(f'{name} streaming failed: {e}')
+            advise = GenerationFailure(classify_exception(e), str(e))
+        finally:
+            if hasattr(stream, 'close'):
+                stream.close()
+
+        if advise is None:
+            if chunks:
+                try:
+                    advise = advisor.parse_advise(''.join(chunks))
+                except Exception as e:
+                    logger.error(f'Parse advise of {name} failed: {e}')
+                    advise = GenerationFailure(classify_exception(e), str(e))
+            elif cancelled.is_set():
+                return self._cancel_backend(name, permit)
+            else:
+                advise = advisor.generate_advise(trip)
+
+        breaker = advisor.circuit_breaker
+        if breaker is not None:
+            if advise or chunks:
+                breaker.record_success()
+            else:
+                breaker.record_failure(getattr(advise, 'reason', REASON_UNKNOWN))
+        if not cancelled.is_set():
+            self.stats[name].record(time.monotonic() - start, bool(advise))
+        return advise
+
+    @timed('hedged_generate')
+    def generate_advise(self, trip):
+        if not trip:
+            logger.warning('No trip brief provided to generate advise.')
+            return GenerationFailure(REASON_INVALID_REQUEST, 'No trip brief')
+
+        backends = self._ready_backends()
+        cancelled = threading.Event()
+        pending = {}
+        failure = GenerationFailure(REASON_UNKNOWN)
+
+        def _fire():
+            # Returns when to hedge, None when no backend could be fired.
+            name, permit = self._next_backend(backends)
+            if name is None:
+                return None
+            future = self.executor.submit(
+                self._run_backend, name, trip, cancelled, permit)
+            pending[future] = name
+            return time.monotonic() + self._deadline(name)
+
+        hedge_at = _fire()
+        if hedge_at is None:
+            return GenerationFailure(
+                REASON_CIRCUIT_OPEN, 'Circuits of all backends are open')
+        try:
+            while pending:
+                timeout = max(0, hedge_at - time.monotonic()) if backends else None
+                done, _ = wait(list(pending), timeout, FIRST_COMPLETED)
+                for future in done:
+                    name = pending.pop(future)
+                    advise = future.result()
+                    if advise:
+                        logger.info(f'{name} won the trip advise race.')
+                        return advise
+                    logger.warning(f'{name} generated no valid advise: {advise!r}')
+                    failure = advise
+                # Hedge when the deadline has passed or a backend failed.
+                if backends and (done or time.monotonic() >= hedge_at):
+                    hedge_at = _fire() or hedge_at
+        finally:
+            cancelled.set()
+
+        return failure
+
+    def _stream_backend(self, name, trip, cancelled, permit, out):
+        # Puts (name, chunk) on out for every chunk of the backend, then
+        # (name, advise) once its text parses or (name, exception) when it
+        # failed. A backend not streaming only puts its advise.
+        advisor = self.advisors[name]
+        breaker = advisor.circuit_breaker
+        start = time.monotonic()
+        stream = advisor.stream_text(trip)
+        chunks = []
+        try:
+            try:
+                for chunk in stream:
+                    if cancelled(name):
+                        self._cancel_backend(name, permit)
+                        return
+                    chunks.append(chunk)
+                    out.put((name, chunk))
+            finally:
+                if hasattr(stream, 'close'):
+                    stream.close()
+            if not chunks:
+                advise = advisor.generate_advise(trip)
+                if not advise:
+                    raise GenerationError(
+                        getattr(advise, 'reason', REASON_UNKNOWN), repr(advise))
+                if cancelled(name):
+                    self._cancel_backend(name, permit)
+                    return
+        except Exception as e:
+            logger.error(f'{name} streaming failed: {e}')
+            if breaker is not None:
+                breaker.record_failure(classify_exception(e))
+            self.stats[name].record(time.monotonic() - start, False)
+            out.put((name, e))
+            return
+
+        # The provider answered, a bad output says nothing about it.
+        if breaker is not None:
+            breaker.record_success()
+        if chunks:
+            try:
+                advise = advisor.parse_advise(''.join(chunks))
+            except Exception as e:
+                logger.error(f'Parse advise of {name} failed: {e}')
+                self.stats[name].record(time.monotonic() - start, False)
+                out.put((name, e))
+                return
+        self.stats[name].record(time.monotonic() - start, True)
+        out.put((name, advise))
+
+    def _race_streams(self, trip):
+        # Fires the backends like generate_advise and yields the
+        # (name, item) put by _stream_backend of every backend running, so
+        # losers keep going until a plan parses. Backends are hedged after
+        # their deadline until one streams, and right away when one fails.
+        # Closing the generator stops the backends still running.
+        backends = self._ready_backends()
+        out = queue.Queue()
+        stopped = threading.Event()
+        running = set()
+        streaming = False
+
+        def _cancelled(name):
+            return stopped.is_set()
+
+        def _fire():
+            name, permit = self._next_backend(backends)
+            if name is None:
+                return None
+            self.executor.submit(
+                self._stream_backend, name, trip, _cancelled, permit, out)
+            running.add(name)
+            return time.monotonic() + self._deadline(name)
+
+        hedge_at = _fire()
+        if hedge_at is None:
+            raise GenerationError(
+                REASON_CIRCUIT_OPEN, 'Circuits of all backends are open')
+
+        try:
+            while running:
+                timeout = max(0, hedge_at - time.monotonic()) \
+                    if backends and not streaming else None
+                try:
+                    name, item = out.get(timeout=timeout)
+                except queue.Empty:
+                    hedge_at = _fire() or hedge_at
+                    continue
+
+                if isinstance(item, str):
+                    streaming = True
+                else:
+                    running.discard(name)
+                if isinstance(item, Exception) and backends:
+                    hedge_at = _fire() or hedge_at
+                yield name, item
+        finally:
+            stopped.set()
+
+    @timed('hedged_stream')
+    def stream_advise(self, trip):
+        # Streams the days of the first backend producing a chunk. The first
+        # plan that parses wins, whichever backend it comes from. When the
+        # streamed backend fails, the days of the backend furthest along
+        # are streamed instead, starting over from their first day.
+        if not trip:
+            logger.warning('No trip brief provided to generate advise.')
+            yield GenerationFailure(REASON_INVALID_REQUEST, 'No trip brief')
+            return
+
+        parsers, days = {}, {}
+        current = None
+        failure = GenerationFailure(REASON_UNKNOWN, 'No backend streamed')
+        race = self._race_streams(trip)
+        try:
+            for name, item in race:
+                if isinstance(item, Exception):
+                    logger.warning(f'{name} generated no valid advise: {item!r}')
+                    failure = GenerationFailure(classify_exception(item), str(item))
+                    parsers.pop(name, None)
+                    days.pop(name, None)
+                    if name == current:
+                        current = max(days, key=lambda n: len(days[n]),
+                                      default=None)
+                        if current is not None:
+                            logger.info(f'{current} took over the trip advise stream.')
+                            yield {'city': trip['city'], 'days': list(days[current]),
+                                   'partial': True}
+                    continue
+                if not isinstance(item, str):
+                    logger.info(f'{name} won the trip advise race.')
+                    yield item
+                    return
+
+                if name not in parsers:
+                    parsers[name] = ArrayItemStreamParser('days')
+                    days[name] = []
+                new_days = parsers[name].feed(item)
+                days[name].extend(new_days)
+                if current is None:
+                    logger.info(f'{name} leads the trip advise stream.')
+                    current = name
+                if name == current and new_days:
+                    yield {'city': trip['city'], 'days': list(days[name]),
+                           'partial': True}
+        except GenerationError as e:
+            failure = GenerationFailure(e.reason, str(e))
+        finally:
+            race.close()
+        yield failure
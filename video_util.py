@@ -6,11 +6,19 @@
 # Last Modified Date: 08.03.2024
 # Last Modified By  : Yan <yanwong@126.com>
 
+from collections import Counter, OrderedDict
+from concurrent.futures import Future
 import json
 import logging
 import os
+import re
+import threading
+import time
+import unicodedata
 
-import requests
+from http_util import get_http_client
+from metrics_util import CacheStats, metrics, timed
+from retry_util import classify_exception
 
 logger = logging.getLogger(__name__)
 
@@ -23,8 +31,9 @@ class BilibiliVideo(object):
         'Referer': 'https://www.bilibili.com'
     }
 
-    def __init__(self, search_url, embed_url):
+    def __init__(self, search_url, embed_url, http_client=None):
         self.search_url = search_url
+        self.http = http_client or get_http_client()
         self.embed_url = embed_url
         self.cookies = {'SESSDATA': os.environ['BILIBILI_SESSDATA']}
 
@@ -32,11 +41,12 @@ class BilibiliVideo(object):
         high_quality = int(high_quality)
         return self.embed_url + f'?aid={aid}&bvid={bvid}&high_quality={high_quality}'
 
+    @timed('bilibili_search')
     def search_video(self, keyword, result_type='video'):
         videoinfo = []
         payload = {'keyword': keyword}
         try:
-            res = requests.get(
+            res = self.http.get(
                 self.search_url, params=payload,
                 headers=BilibiliVideo.HEADERS, cookies=self.cookies
             )
@@ -48,6 +58,7 @@ class BilibiliVideo(object):
 
         except Exception as e:
             logger.error('Request bilibili search api failed: {}'.format(e))
+            metrics.count_error('bilibili_search', classify_exception(e))
 
         return videoinfo
 
@@ -63,3 +74,124 @@ class BilibiliVideo(object):
         aid, bvid = videoinfo['aid'], videoinfo['bvid']
         return self.get_embed_html_by_id(aid, bvid, high_quality)
 
+
+def normalize_keyword(keyword):
+    keyword = unicodedata.normalize('NFKC', keyword).strip().lower()
+    return re.sub(r'\s+', '', keyword)
+
+class VideoStore(CacheStats):
+    # Remembers the video chosen for every city, so that bilibili is only
+    # searched once per city and ttl. Only aid and bvid of the first result
+    # are kept, which is all get_embed_html needs. Cities without any video
+    # are remembered for miss_ttl. A background refresher keeps the videos
+    # of the most requested cities cached.
+
+    def __init__(self, video, suffix='宣传片', ttl=7 * 24 * 3600, miss_ttl=600,
+                 max_entries=2048):
+        self.video = video
+        self.suffix = suffix
+        self.ttl = ttl
+        self.miss_ttl = miss_ttl
+        self.max_entries = max_entries
+
+        self._entries = OrderedDict()  # key -> (expires, videoinfo or None)
+        self._inflight = {}  # key -> Future
+        self._hits = Counter()
+        self.hits = 0
+        self.misses = 0
+        self._cities = {}  # key -> city as requested
+        self._lock = threading.Lock()
+        self._refresher = None
+        self._stop = threading.Event()
+
+    def _fetch(self, key, city):
+        with self._lock:
+            future = self._inflight.get(key)
+            owner = future is None
+            if owner:
+                future = Future()
+                self._inflight[key] = future
+
+        if not owner:
+            return future.result()
+
+        videoinfo = None
+        try:
+            found = self.video.search_video(city + self.suffix)
+            if found:
+                videoinfo = {'aid': found[0]['aid'], 'bvid': found[0]['bvid']}
+            expires = time.time() + (self.ttl if videoinfo else self.miss_ttl)
+            with self._lock:
+                self._entries[key] = (expires, videoinfo)
+                self._entries.move_to_end(key)
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+        finally:
+            with self._lock:
+                del self._inflight[key]
+            future.set_result(videoinfo)
+        return videoinfo
+
+    def get_video(self, city):
+        key = normalize_keyword(city)
+        with self._lock:
+            self._hits[key] += 1
+            self._cities.setdefault(key, city)
+            entry = self._entries.get(key)
+            if entry and entry[0] > time.time():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+
+        return self._fetch(key, city)
+
+    def prefetch(self, cities):
+        for city in cities:
+            key = normalize_keyword(city)
+            with self._lock:
+                self._cities.setdefault(key, city)
+                if key in self._entries:
+                    continue
+            self._fetch(key, city)
+
+    def refresh_hot(self, top_n, ahead=0):
+        with self._lock:
+            hot = [key for key, _ in self._hits.most_common(top_n)]
+            deadline = time.time() + ahead
+            stale = [
+                key for key in hot
+                if key not in self._entries or self._entries[key][0] <= deadline
+            ]
+        for key in stale:
+            self._fetch(key, self._cities[key])
+        return stale
+
+    def start_refresher(self, top_n=50, interval=600, cities=()):
+        # cities are fetched first, before any request tells which are hot.
+        if self._refresher is not None:
+            return
+
+        def _run():
+            try:
+                self.prefetch(cities)
+            except Exception as e:
+                logger.error('Prefetch videos failed: {}'.format(e))
+            while not self._stop.wait(interval):
+                try:
+                    stale = self.refresh_hot(top_n, ahead=interval)
+                    if stale:
+                        logger.info(f'Refreshed videos of {len(stale)} cities.')
+                except Exception as e:
+                    logger.error('Refresh videos failed: {}'.format(e))
+
+        self._stop.clear()
+        self._refresher = threading.Thread(
+            target=_run, name='video-refresher', daemon=True)
+        self._refresher.start()
+
+    def stop_refresher(self):
+        self._stop.set()
+        if self._refresher is not None:
+            self._refresher.join()
+            self._refresher = None
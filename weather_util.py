@@ -7,40 +7,204 @@
 # Last Modified By  : Yan <yanwong@126.com>
 
 import os
+import csv
 import json
 import logging
-import requests
-from datetime import date
+import threading
+import unicodedata
+import time
+from collections import Counter, OrderedDict
+from concurrent.futures import Future
+from datetime import date, datetime, timedelta, timezone
 
-from map_util import GaodeGeo
+from http_util import get_http_client
+from map_util import GaodeGeo, classify_gaode_info
+from metrics_util import CacheStats, metrics, timed
+from retry_util import classify_exception
 
 logger = logging.getLogger(__name__)
 
+# Gaode reports times in Beijing time without a timezone.
+GAODE_TIMEZONE = timezone(timedelta(hours=8))
+
+class WeatherClassifier(object):
+    # Maps Gaode weather strings to the coarse classes listed in
+    # data/weather_class.csv. The table mixes CJK radicals into some names
+    # (e.g. ⼤雨), so every string is NFKC normalized before matching.
+
+    UNKNOWN = 'unknown'
+    # Compound weathers like 阴转小雨 take their most severe class.
+    SEVERITY = ['unknown', 'sunny', 'cloudy', 'rain', 'snow']
+
+    def __init__(self, weather_path):
+        self.classes = {}
+        with open(weather_path, encoding='utf-8-sig') as f:
+            reader = csv.reader(f)
+            next(reader)  # skip header
+            for row in reader:
+                if len(row) >= 2 and row[0].strip():
+                    name = unicodedata.normalize('NFKC', row[0].strip())
+                    self.classes[name] = row[1].strip()
+        # Longest names first, so 雷阵雨伴有冰雹 wins over 冰雹.
+        self.names = sorted(self.classes, key=len, reverse=True)
+
+    def _classify_one(self, weather):
+        if weather in self.classes:
+            return self.classes[weather]
+        for name in self.names:
+            if name in weather:
+                return self.classes[name]
+        return WeatherClassifier.UNKNOWN
+
+    def classify(self, weather):
+        if not weather:
+            return WeatherClassifier.UNKNOWN
+        weather = unicodedata.normalize('NFKC', weather.strip())
+        classes = [self._classify_one(w) for w in weather.split('转')]
+        return max(classes, key=WeatherClassifier.SEVERITY.index)
+
 class GaodeWeather(object):
-    def __init__(self, geo, weather_url):
+    def __init__(self, geo, weather_url, http_client=None):
         self.api_key = os.environ['GAODE_API_KEY']
+        self.http = http_client or get_http_client()
         self.geo = geo
         self.weather_url = weather_url
 
     def get_forecast(self, geocode, forecast_type='all'):
-        forecast = []
+        return self.get_forecast_report(geocode['adcode'], forecast_type)[0]
+
+    @timed('gaode_weather')
+    def get_forecast_report(self, adcode, forecast_type='all'):
+        forecast, report_time = [], None
         payload = {
-            'city': geocode['adcode'],
+            'city': adcode,
             'key': self.api_key,
             'extensions': forecast_type
         }
         try:
-            res = requests.get(self.weather_url, params=payload)
+            res = self.http.get(self.weather_url, params=payload)
             res_content = json.loads(res.text)
             if res_content['status'] == 0:
                 logger.error('Gaode weather api error: {}'.format(res_content['info']))
+                metrics.count_error(
+                    'gaode_weather', classify_gaode_info(res_content['info']))
             else:
+                report = res_content['forecasts'][0]
                 forecast = [{'date': date.fromisoformat(ca['date']),
                              'day_weather': ca['dayweather'],
                              'night_weather': ca['nightweather']}
-                             for ca in res_content['forecasts'][0]['casts']]
+                             for ca in report['casts']]
+                if report.get('reporttime'):
+                    report_time = datetime.strptime(
+                        report['reporttime'], '%Y-%m-%d %H:%M:%S'
+                    ).replace(tzinfo=GAODE_TIMEZONE)
         except Exception as e:
             logger.error('Request gaode weather api failed: {}'.format(e))
+            metrics.count_error('gaode_weather', classify_exception(e))
+
+        return forecast, report_time
+
+class ForecastStore(CacheStats):
+    # Keeps the latest forecast of every adcode in memory, indexed by date.
+    # Gaode publishes new forecasts a few times a day, so an entry stays
+    # fresh until refresh_interval after its report time (but at least
+    # min_ttl from now). Concurrent requests for the same adcode share one
+    # upstream call.
+
+    def __init__(self, weather, refresh_interval=3 * 3600, min_ttl=600,
+                 max_entries=4096):
+        self.weather = weather
+        self.refresh_interval = refresh_interval
+        self.min_ttl = min_ttl
+        self.max_entries = max_entries
+
+        self._entries = OrderedDict()  # adcode -> (expires, {date: weather})
+        self._inflight = {}  # adcode -> Future
+        self._hits = Counter()
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._refresher = None
+        self._stop = threading.Event()
+
+    def _expires(self, report_time):
+        now = time.time()
+        if report_time is None:
+            return now + self.min_ttl
+        return max(report_time.timestamp() + self.refresh_interval,
+                   now + self.min_ttl)
+
+    def _fetch(self, adcode):
+        with self._lock:
+            future = self._inflight.get(adcode)
+            owner = future is None
+            if owner:
+                future = Future()
+                self._inflight[adcode] = future
+
+        if not owner:
+            return future.result()
+
+        by_date = {}
+        try:
+            forecast, report_time = self.weather.get_forecast_report(adcode)
+            by_date = {f['date']: f for f in forecast}
+            with self._lock:
+                if by_date:
+                    self._entries[adcode] = (self._expires(report_time), by_date)
+                    self._entries.move_to_end(adcode)
+                    while len(self._entries) > self.max_entries:
+                        self._entries.popitem(last=False)
+        finally:
+            with self._lock:
+                del self._inflight[adcode]
+            future.set_result(by_date)
+        return by_date
+
+    def get_forecast(self, adcode):
+        with self._lock:
+            self._hits[adcode] += 1
+            entry = self._entries.get(adcode)
+            if entry and entry[0] > time.time():
+                self._entries.move_to_end(adcode)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+
+        return self._fetch(adcode)
+
+    def refresh_hot(self, top_n, ahead=0):
+        with self._lock:
+            hot = [ad for ad, _ in self._hits.most_common(top_n)]
+            deadline = time.time() + ahead
+            stale = [
+                ad for ad in hot
+                if ad not in self._entries or self._entries[ad][0] <= deadline
+            ]
+        for adcode in stale:
+            self._fetch(adcode)
+        return stale
+
+    def start_refresher(self, top_n=50, interval=300):
+        if self._refresher is not None:
+            return
+
+        def _run():
+            while not self._stop.wait(interval):
+                try:
+                    stale = self.refresh_hot(top_n, ahead=interval)
+                    if stale:
+                        logger.info(f'Refreshed forecasts of {len(stale)} adcodes.')
+                except Exception as e:
+                    logger.error('Refresh forecasts failed: {}'.format(e))
 
-        return forecast
+        self._stop.clear()
+        self._refresher = threading.Thread(
+            target=_run, name='forecast-refresher', daemon=True)
+        self._refresher.start()
 
+    def stop_refresher(self):
+        self._stop.set()
+        if self._refresher is not None:
+            self._refresher.join()
+            self._refresher = None